@@ -0,0 +1,182 @@
+""" Benchmark playbook load, keyword processing, render and execution.
+
+Usage:
+    python benchmarks/bench_playbook.py [--size small|large] [--repeat N]
+        [--scenario NAME ...] [--output results.json]
+        [--compare baseline.json]
+
+Each phase is timed separately on a fresh playbook and with yasql's
+in-process caches cleared, and the results are written as JSON so that
+two runs can be compared with --compare.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+from collections import OrderedDict
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yasql
+from yasql.playbook import Playbook
+from yasql.context import ctx
+from yasql import yaml_parser
+from yasql.utils import compile_template
+from yasql.syntax import datetime as dt
+
+from generators import SCENARIOS, SOURCE_TABLES
+
+PHASES = ['load', 'queries', 'render', 'execute']
+
+
+def plain(data):
+    if isinstance(data, dict):
+        return {k: plain(v) for k, v in data.items()}
+    elif isinstance(data, list):
+        return [plain(i) for i in data]
+    return data
+
+
+def write_playbook(files, directory):
+    for name, data in files.items():
+        with open(os.path.join(directory, name), 'w') as f:
+            yaml.safe_dump(plain(data), f, sort_keys=False)
+    return os.path.join(directory, next(iter(files)))
+
+
+def create_source_tables(engine):
+    for name, table in SOURCE_TABLES.items():
+        engine.execute('DROP TABLE IF EXISTS {}'.format(name))
+        engine.execute('CREATE TABLE {} ({})'.format(name, table['columns']))
+        placeholders = ', '.join(['?'] * len(table['rows'][0]))
+        engine.execute('INSERT INTO {} VALUES ({})'.format(name, placeholders),
+                       table['rows'])
+
+
+def clear_caches():
+    compile_template.cache_clear()
+    dt.parse_cache.clear()
+    yaml_parser.file_cache.clear()
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def run_once(path, db_path):
+    clear_caches()
+    timings = OrderedDict()
+    timings['load'], playbook = timed(lambda: Playbook.load_from_path(path))
+    playbook.config.update({'db_conn': 'sqlite:///{}'.format(db_path)})
+    ctx.playbook = playbook
+    ctx.dry = False
+    ctx.print_result = False
+
+    timings['queries'], _ = timed(
+        lambda: [q.data for q in playbook.queries])
+    timings['render'], _ = timed(
+        lambda: [q.render_sql() for q in playbook.queries])
+
+    engine = playbook.config.db_conn
+    create_source_tables(engine)
+    timings['execute'], _ = timed(playbook.execute)
+    engine.dispose()
+    return timings
+
+
+def summarize(runs):
+    return OrderedDict(
+        (phase, OrderedDict([
+            ('min', min(r[phase] for r in runs)),
+            ('median', statistics.median(r[phase] for r in runs)),
+            ('runs', [r[phase] for r in runs]),
+        ]))
+        for phase in PHASES)
+
+
+def run_scenario(name, size, repeat):
+    generator, sizes = SCENARIOS[name]
+    directory = tempfile.mkdtemp(prefix='yasql-bench-')
+    try:
+        path = write_playbook(generator(sizes[size]), directory)
+        runs = []
+        for i in range(repeat):
+            db_path = os.path.join(directory, 'bench{}.db'.format(i))
+            runs.append(run_once(path, db_path))
+        return OrderedDict([
+            ('scenario', name),
+            ('size', size),
+            ('param', sizes[size]),
+            ('phases', summarize(runs)),
+        ])
+    finally:
+        shutil.rmtree(directory)
+
+
+def compare(results, baseline):
+    base = {(r['scenario'], r['size']): r for r in baseline['results']}
+    print('{:<20} {:<10} {:>12} {:>12} {:>8}'.format(
+        'scenario', 'phase', 'baseline', 'current', 'ratio'))
+    for result in results['results']:
+        other = base.get((result['scenario'], result['size']))
+        if not other:
+            continue
+        for phase in PHASES:
+            before = other['phases'][phase]['min']
+            after = result['phases'][phase]['min']
+            print('{:<20} {:<10} {:>11.4f}s {:>11.4f}s {:>7.2f}x'.format(
+                result['scenario'], phase, before, after,
+                before / after if after else float('inf')))
+
+
+def print_results(results):
+    print('{:<20} {}'.format('scenario', ''.join(
+        '{:>12}'.format(p) for p in PHASES)))
+    for result in results['results']:
+        print('{:<20} {}'.format(result['scenario'], ''.join(
+            '{:>11.4f}s'.format(result['phases'][p]['min'])
+            for p in PHASES)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', choices=['small', 'large'],
+                        default='small')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scenario', action='append',
+                        choices=list(SCENARIOS))
+    parser.add_argument('--output', help='Write results to a JSON file')
+    parser.add_argument('--compare', help='Baseline JSON results')
+    args = parser.parse_args()
+
+    results = OrderedDict([
+        ('meta', OrderedDict([
+            ('yasql_version', yasql.__version__),
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('repeat', args.repeat),
+        ])),
+        ('results', [run_scenario(name, args.size, args.repeat)
+                     for name in args.scenario or SCENARIOS]),
+    ])
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+""" Benchmark the startup time of the yasql CLI.
+
+Usage:
+    python benchmarks/bench_startup.py [--repeat N] [--output results.json]
+        [--compare baseline.json]
+
+Each command runs in a fresh Python process: importing the CLI module, and
+`yasql --dry` on small generated playbooks, with and without datetime
+expressions (which load the date grammar).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import statistics
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yasql
+
+from generators import many_queries, dt_filters
+from bench_playbook import write_playbook
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def commands(directory):
+    plain = write_playbook(many_queries(5), os.path.join(directory, 'plain'))
+    dates = write_playbook(dt_filters(5), os.path.join(directory, 'dates'))
+    cli = [sys.executable, '-m', 'yasql.cli', '--quiet', '--dry']
+    return OrderedDict([
+        ('import', [sys.executable, '-c', 'import yasql.cli']),
+        ('dry_plain', cli + [plain]),
+        ('dry_dates', cli + [dates]),
+    ])
+
+
+def timed_run(cmd):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    subprocess.run(cmd, check=True, env=env, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def run(repeat):
+    directory = tempfile.mkdtemp(prefix='yasql-bench-')
+    try:
+        for name in ('plain', 'dates'):
+            os.mkdir(os.path.join(directory, name))
+        results = OrderedDict()
+        for name, cmd in commands(directory).items():
+            # Warm up the OS file cache and on-disk caches
+            timed_run(cmd)
+            runs = [timed_run(cmd) for i in range(repeat)]
+            results[name] = OrderedDict([
+                ('min', min(runs)),
+                ('median', statistics.median(runs)),
+                ('runs', runs),
+            ])
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+def compare(results, baseline):
+    print('{:<12} {:>12} {:>12} {:>8}'.format(
+        'command', 'baseline', 'current', 'ratio'))
+    for name, result in results['results'].items():
+        other = baseline['results'].get(name)
+        if not other:
+            continue
+        before, after = other['min'], result['min']
+        print('{:<12} {:>11.4f}s {:>11.4f}s {:>7.2f}x'.format(
+            name, before, after, before / after if after else float('inf')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='Write results to a JSON file')
+    parser.add_argument('--compare', help='Baseline JSON results')
+    args = parser.parse_args()
+
+    results = OrderedDict([
+        ('meta', OrderedDict([
+            ('yasql_version', yasql.__version__),
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('repeat', args.repeat),
+        ])),
+        ('results', run(args.repeat)),
+    ])
+    for name, result in results['results'].items():
+        print('{:<12} {:>11.4f}s'.format(name, result['min']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
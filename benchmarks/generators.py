@@ -0,0 +1,139 @@
+""" Synthetic playbook generators used by the benchmarks.
+
+Each generator returns a dict of {file name: playbook data}, the first
+entry being the playbook to load. Queries read from the `events` table,
+see `SOURCE_TABLES`, and materialize their results into tables so that
+they can be executed against a local SQLite database.
+"""
+from collections import OrderedDict
+
+SOURCE_TABLES = {
+    'events': {
+        'columns': 'id int, user_id int, region text, amount int, day text',
+        'rows': [
+            (i, i % 50, ['us', 'eu', 'asia'][i % 3], i * 10,
+             '2018-01-{:02d} 00:00:00'.format(i % 28 + 1))
+            for i in range(1000)
+        ],
+    },
+}
+
+
+def _query(name, **select):
+    select.setdefault('from', 'events')
+    return OrderedDict([
+        ('name', name),
+        ('select', select),
+        ('output', 'bench_' + name),
+    ])
+
+
+def many_queries(n):
+    """ N independent queries """
+    queries = [
+        _query('q{}'.format(i),
+               fields=['user_id', {'total': 'sum(amount)'}],
+               where={'region': ['us', 'eu'], 'id': i},
+               group_by='user_id')
+        for i in range(n)
+    ]
+    return {'main.yaml': {'queries': queries}}
+
+
+def with_chain(depth):
+    """ Each query references the previous one through `with` """
+    queries = [_query('q0', fields=['id', 'user_id', 'amount'])]
+    for i in range(1, depth):
+        prev = 'q{}'.format(i - 1)
+        queries.append(_query(
+            'q{}'.format(i),
+            fields=['id', 'user_id', 'amount'],
+            where=['amount > {}'.format(i)],
+            **{'with': {'prev': prev}, 'from': 'prev'}))
+    return {'main.yaml': {'queries': queries}}
+
+
+def heavy_templates(n):
+    """ N queries built from templates with mako vars and expressions """
+    templates = OrderedDict()
+    for i in range(10):
+        templates['tmpl{}'.format(i)] = {
+            'select': OrderedDict([
+                ('fields', ['${group_col}', {'total': '${agg}(amount)'}]),
+                ('from', '${table}'),
+                ('where', [
+                    "region = '${region}'",
+                    'user_id = ${user_id}',
+                    'amount > ${threshold * %d}' % (i + 1),
+                ]),
+                ('group_by', '${group_col}'),
+            ])
+        }
+    queries = []
+    for i in range(n):
+        queries.append(OrderedDict([
+            ('name', 'q{}'.format(i)),
+            ('template', 'tmpl{}'.format(i % 10)),
+            ('vars', {'user_id': i % 50, 'region': ['us', 'eu'][i % 2]}),
+            ('output', 'bench_q{}'.format(i)),
+        ]))
+    data = OrderedDict([
+        ('vars', {'table': 'events', 'agg': 'sum', 'group_col': 'user_id',
+                  'threshold': 10}),
+        ('templates', templates),
+        ('queries', queries),
+    ])
+    return {'main.yaml': data}
+
+
+def dt_filters(n):
+    """ N queries with several `dt |` filters each """
+    exprs = ['dt | last month', 'dt | since 3 days ago', 'dt | 2018-01',
+             'dt | since 2018-01-01 until 2018-01-15', 'dt | in last 7 days',
+             'dt | this year']
+    queries = [
+        _query('q{}'.format(i), fields=['id'],
+               where={'day': exprs[i % len(exprs)]})
+        for i in range(n)
+    ]
+    return {'main.yaml': {'queries': queries}}
+
+
+def nested_imports(levels, n=10):
+    """ A chain of playbooks, each importing vars and templates from the
+    next one """
+    files = OrderedDict()
+    for level in range(levels):
+        data = OrderedDict()
+        if level + 1 < levels:
+            data['imports'] = [
+                {'from': 'lib{}.yaml'.format(level + 1), 'import': 'vars'},
+                {'from': 'lib{}.yaml'.format(level + 1),
+                 'import': 'templates', 'as': 'lib'},
+            ]
+        data['vars'] = {'v{}'.format(level): level}
+        data['templates'] = {
+            't{}'.format(level): {
+                'select': {'fields': ['id'], 'from': 'events',
+                           'where': ['id > ${v%d}' % level]}
+            }
+        }
+        files['lib{}.yaml'.format(level)] = data
+    main = files.pop('lib0.yaml')
+    main['queries'] = [
+        OrderedDict([('name', 'q{}'.format(i)), ('template', 't0'),
+                     ('output', 'bench_q{}'.format(i))])
+        for i in range(n)
+    ]
+    result = OrderedDict([('main.yaml', main)])
+    result.update(files)
+    return result
+
+
+SCENARIOS = OrderedDict([
+    ('many_queries', (many_queries, {'small': 50, 'large': 1000})),
+    ('with_chain', (with_chain, {'small': 10, 'large': 50})),
+    ('heavy_templates', (heavy_templates, {'small': 50, 'large': 1000})),
+    ('dt_filters', (dt_filters, {'small': 50, 'large': 500})),
+    ('nested_imports', (nested_imports, {'small': 5, 'large': 20})),
+])
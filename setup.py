@@ -13,7 +13,7 @@ with open('HISTORY.rst') as history_file:
 
 requirements = [
     'Click>=6.0',
-    'sqlalchemy',
+    'sqlalchemy>=1.4',
     'sqlparse',
     'funcy',
     'PyYAML',
@@ -23,6 +23,11 @@ requirements = [
     'tabulate'
 ]
 
+extra_requirements = {
+    'arrow': ['pyarrow'],
+    'async': ['aiosqlite', 'asyncpg', 'aiomysql'],
+}
+
 setup_requirements = ['pytest-runner', ]
 
 test_requirements = ['pytest', 'freezegun' ]
@@ -50,6 +55,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extra_requirements,
     license="MIT license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
@@ -4,15 +4,32 @@
 """Tests for `yasql` package."""
 
 import os
+import string
+import _thread
+import threading
+import asyncio
+import json
+from datetime import datetime
 
 import pytest
+import pytz
 import dateparser as dp
 from freezegun import freeze_time
+import sqlalchemy as sa
 from sqlalchemy import create_engine
 
-from yasql.playbook import Playbook
-from yasql.utils import sql_format
+from yasql.playbook import Playbook, QueryNotExists, DuplicateQueryNames
+from yasql.sql_render import SQLRender
+from yasql.dag import CyclicDependency
+from yasql.cache import ResultCache
+from yasql.config import dispose_engines, dispose_engines_async, async_url
+from yasql.base import dict_cls
+from yasql import yaml_parser
+from yasql import utils
+from yasql.utils import sql_format, inject_vars, compile_template
 from yasql.context import ctx
+from yasql.profiling import profiler
+from yasql.watch import Watcher
 from yasql.syntax import datetime as dt
 
 def data_path(fname):
@@ -67,6 +84,15 @@ def test_import_vars():
 def test_import_templates():
     _test_query('import.yaml', 'test_import_templates')
 
+def test_template_update_vars():
+    playbook = Playbook.load_from_path(data_path('import.yaml'))
+    query = playbook.get_query('test_import_templates')
+    ctx.playbook = playbook
+    sql = query.render_sql()
+    # The query is processed again, with its template
+    playbook.update_vars({'col': 'baz'})
+    assert query.render_sql() == sql
+
 
 ### Where clause
 
@@ -89,3 +115,719 @@ def test_where_rel_date1():
 @freeze_time('2018-08-15 10:00:00')
 def test_where_rel_date2():
     _test_query('where_clause.yaml', 'test_rel_date2')
+
+### Dependency graph
+
+def _load_sqlite_playbook(tmpdir, fname, **vars):
+    """ Playbook of tests/data executed on a SQLite database in tmpdir """
+    playbook = Playbook.load_from_path(data_path(fname))
+    db_path = os.path.join(str(tmpdir), os.path.splitext(fname)[0] + '.db')
+    playbook.config.update({'db_conn': 'sqlite:///{}'.format(db_path)})
+    if vars:
+        playbook.update_vars(vars)
+    ctx.playbook = playbook
+    return playbook
+
+def test_dependency_graph(tmpdir):
+    playbook = _load_sqlite_playbook(tmpdir, 'dag.yaml')
+    graph = playbook.graph()
+    deps = {q.name: [d.name for d in graph.dependencies(q)]
+            for q in playbook.queries}
+    assert deps == {
+        'users': [],
+        'orders': [],
+        'user_orders': ['users', 'orders'],
+        'total': ['user_orders'],
+        'standalone': [],
+    }
+    assert [q.name for q in graph.order()] == \
+        ['users', 'orders', 'user_orders', 'total', 'standalone']
+    assert [[q.name for q in stage] for stage in graph.stages()] == \
+        [['users', 'orders', 'standalone'], ['user_orders'], ['total']]
+
+def test_plan(tmpdir):
+    playbook = _load_sqlite_playbook(tmpdir, 'dag.yaml')
+    playbook.config.db_conn.execute('create table dag_users (id int)')
+    plan = playbook.plan().split('\n')
+    assert plan[:4] == ['Execution plan: 5 queries in 3 stages',
+                        'Stage 1: users, orders, standalone',
+                        'Stage 2: user_orders',
+                        'Stage 3: total']
+    assert 'Query user_orders, after users, orders' in plan
+    # EXPLAIN of user_orders fails as dag_orders doesn't exist yet
+    assert any(l.startswith('    EXPLAIN not available') for l in plan)
+    assert any('SCAN' in l for l in plan)
+
+def test_parallel_execute(tmpdir):
+    playbook = _load_sqlite_playbook(tmpdir, 'dag.yaml')
+    playbook.execute(jobs=4)
+    rows = playbook.config.db_conn.execute('select total from dag_total')
+    assert rows.fetchall() == [(30,)]
+
+def test_run_manifest(tmpdir, monkeypatch):
+    playbook = _load_sqlite_playbook(tmpdir, 'manifest.yaml')
+    manifest_path = os.path.join(str(tmpdir), 'manifest.json')
+    playbook.config.update({'manifest': manifest_path})
+    built = []
+    original = utils.execute_transaction
+    def _execute_transaction(conn, statements, **kwargs):
+        built.append(statements[-1].split()[-1])
+        return original(conn, statements, **kwargs)
+    monkeypatch.setattr('yasql.playbook.execute_transaction',
+                        _execute_transaction)
+
+    playbook.execute()
+    assert built == ['m_users', 'm_user_count', 'm_standalone']
+    with open(manifest_path) as f:
+        entry = json.load(f)['queries']['user_count']['m_user_count']
+    assert set(entry['inputs']) == {'m_users'}
+
+    built.clear()
+    playbook.execute()
+    assert built == []
+
+    # Dependents of a rebuilt table are rebuilt
+    playbook.config.db_conn.execute('drop table m_users')
+    playbook.execute()
+    assert built == ['m_users', 'm_user_count']
+
+    built.clear()
+    ctx.force = True
+    try:
+        playbook.execute()
+    finally:
+        ctx.force = False
+    assert built == ['m_users', 'm_user_count', 'm_standalone']
+
+def test_parallel_execute_memory_db():
+    playbook = Playbook.load_from_path(data_path('dag.yaml'))
+    playbook.config.update({'db_conn': 'sqlite://'})
+    ctx.playbook = playbook
+    playbook.execute(jobs=4)
+    rows = playbook.config.db_conn.execute('select total from dag_total')
+    assert rows.fetchall() == [(30,)]
+
+def test_materialize(tmpdir, monkeypatch):
+    playbook = _load_sqlite_playbook(tmpdir, 'materialize.yaml')
+    executed = []
+    original = utils.execute_sql
+    def _execute_sql(conn, sql, **kwargs):
+        executed.append(str(sql))
+        return original(conn, sql, **kwargs)
+    monkeypatch.setattr(utils, 'execute_sql', _execute_sql)
+
+    assert 'FROM yasql_cte_base AS b' in \
+        playbook.get_query('large').compile_sql()
+    playbook.execute(jobs=2)
+    base_sql = playbook.get_query('base').compile_sql()
+    assert len([sql for sql in executed if base_sql in sql]) == 1
+    engine = playbook.config.db_conn
+    assert engine.execute('select total from cte_total').fetchall() == \
+        [(30,)]
+    assert engine.execute('select id from cte_large').fetchall() == [(2,)]
+    assert not utils.table_exists(engine, 'yasql_cte_base')
+
+def test_materialize_async(tmpdir):
+    pytest.importorskip('aiosqlite')
+    playbook = _load_sqlite_playbook(tmpdir, 'materialize.yaml')
+    async def _run():
+        try:
+            await playbook.execute_async()
+        finally:
+            await dispose_engines_async()
+    asyncio.run(_run())
+    engine = playbook.config.db_conn
+    assert engine.execute('select id from cte_large').fetchall() == [(2,)]
+    assert not utils.table_exists(engine, 'yasql_cte_base')
+
+def test_materialize_threshold(tmpdir):
+    playbook = _load_sqlite_playbook(tmpdir, 'materialize.yaml')
+    shared = playbook.get_query('shared')
+    assert shared.materialized_table is None
+    playbook.config.update({'materialize_threshold': 2})
+    assert shared.materialized_table == 'yasql_cte_shared'
+    playbook.config.update({'materialize_threshold': 3})
+    assert shared.materialized_table is None
+
+### Rendering
+
+def test_render_cache(monkeypatch):
+    playbook = Playbook.load_from_path(data_path('import.yaml'))
+    ctx.playbook = playbook
+    query = playbook.get_query('test_import_vars')
+    renders = []
+    original = SQLRender.render
+    def _render(self):
+        renders.append(self)
+        return original(self)
+    monkeypatch.setattr(SQLRender, 'render', _render)
+
+    sql = query.render_sql()
+    assert query.render_sql() == sql
+    assert len(renders) == 1
+
+    playbook.update_vars({'table': 'other'})
+    assert 'FROM other' in query.render_sql()
+    assert len(renders) == 2
+
+### Playbook
+
+def test_query_index():
+    playbook = Playbook.load_from_path(data_path('import.yaml'))
+    assert playbook.query_names == ['test_import_vars',
+                                    'test_import_templates']
+    assert playbook.has_query('test_import_vars')
+    assert not playbook.has_query('missing')
+    with pytest.raises(QueryNotExists):
+        playbook.get_query('missing')
+
+def test_playbook_file_cache(monkeypatch):
+    yaml_parser.file_cache.clear()
+    parsed = []
+    original = yaml_parser.parse
+    def _parse(content):
+        parsed.append(content)
+        return original(content)
+    monkeypatch.setattr(yaml_parser, 'parse', _parse)
+    playbook = Playbook.load_from_path(data_path('import.yaml'))
+    # base_vars.yaml is imported twice but parsed once
+    assert len(parsed) == 3
+    playbook.update_vars({'col': 'baz'})
+    other = Playbook.load_from_path(data_path('import.yaml'))
+    assert len(parsed) == 3
+    assert other.get('vars')['col'] == 'bar'
+
+def test_playbook_disk_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(yaml_parser, 'cache_dir', str(tmpdir))
+    yaml_parser.file_cache.clear()
+    expected = yaml_parser.load_file(data_path('basic.yaml'))
+    assert len(tmpdir.listdir()) == 1
+    yaml_parser.file_cache.clear()
+    def _parse(content):
+        raise AssertionError('Playbook should be loaded from disk cache')
+    monkeypatch.setattr(yaml_parser, 'parse', _parse)
+    assert yaml_parser.load_file(data_path('basic.yaml')) == expected
+    yaml_parser.file_cache.clear()
+
+def test_duplicated_query_names():
+    playbook = Playbook('queries: [{name: q1, sql: a}, {name: q1, sql: b}]')
+    with pytest.raises(DuplicateQueryNames):
+        playbook.queries
+
+def test_lazy_queries():
+    playbook = Playbook.load_from_path(data_path('basic.yaml'))
+    ctx.playbook = playbook
+    playbook.get_query('test_with').render_sql()
+    processed = [q.name for q in playbook.queries if q._data is not None]
+    assert processed == ['test_vars', 'test_template', 'test_with']
+
+def test_cyclic_with():
+    playbook = Playbook('''
+queries:
+  - name: q1
+    select: {with: q2, from: q2}
+  - name: q2
+    select: {with: q1, from: q1}
+''')
+    ctx.playbook = playbook
+    with pytest.raises(CyclicDependency):
+        playbook.get_query('q1').render_sql()
+
+### Vars
+
+def test_inject_vars_template_cache():
+    compile_template.cache_clear()
+    data = dict_cls(a='${x} and ${y}', b=['${x} and ${y}', 'plain'])
+    assert inject_vars(data, {'x': 1, 'y': 2}) == \
+        dict_cls(a='1 and 2', b=['1 and 2', 'plain'])
+    assert inject_vars(data, {'x': 3, 'y': 4})['a'] == '3 and 4'
+    info = compile_template.cache_info()
+    assert (info.misses, info.hits) == (1, 3)
+
+### Datetime expressions
+
+@freeze_time('2018-08-15 10:00:00')
+def test_dt_expr_direct_arithmetic(monkeypatch):
+    def _fail(expr):
+        raise AssertionError('dateparser used for {}'.format(expr))
+    monkeypatch.setattr(dt, 'dt_parse_func', _fail)
+    assert dt.parse_dt_expr('dt | since 3 weeks ago', tz=pytz.utc) == \
+        ('2018-07-25 00:00:00', None)
+    assert dt.parse_dt_expr('dt | 2 months ago', tz=pytz.utc) == \
+        '2018-06-15 00:00:00'
+
+def test_dt_expr_cache(monkeypatch):
+    trees = []
+    class _Parser(object):
+        def parse(self, expr):
+            trees.append(expr)
+            return dt.get_parser('lalr').parse(expr)
+    monkeypatch.setattr(dt, 'parser', _Parser())
+    now = datetime(2018, 8, 15, 10)
+    for i in range(3):
+        result = dt.parse_dt_expr('dt | 2018-05', tz=pytz.utc, now=now)
+    assert result == ('2018-05-01 00:00:00', '2018-06-01 00:00:00')
+    assert trees == ['dt | 2018-05']
+
+def test_dt_expr_run_reference_time(monkeypatch):
+    monkeypatch.setattr(ctx, 'now', datetime(2018, 8, 15, 10))
+    assert dt.parse_dt_expr('dt | 3 days ago', tz=pytz.utc) == \
+        '2018-08-12 00:00:00'
+
+def test_render_cache_across_runs(tmpdir, monkeypatch):
+    playbook = _load_sqlite_playbook(tmpdir, 'dag.yaml')
+    renders = []
+    original = SQLRender.render
+    def _render(self):
+        renders.append(self)
+        return original(self)
+    monkeypatch.setattr(SQLRender, 'render', _render)
+    monkeypatch.setattr(ctx, 'dry', True)
+    playbook.execute(queries=['standalone'])
+    playbook.execute(queries=['standalone'])
+    assert len(renders) == 1
+
+    # Relative dates are rendered with the time of each run
+    playbook = Playbook.load_from_path(data_path('where_clause.yaml'))
+    ctx.playbook = playbook
+    query = playbook.get_query('test_rel_date2')
+    monkeypatch.setattr(ctx, 'now', datetime(2018, 8, 15, 10))
+    sql = query.compile_sql()
+    monkeypatch.setattr(ctx, 'now', datetime(2018, 9, 15, 10))
+    assert query.compile_sql() == sql
+    playbook.begin_run()
+    assert query.compile_sql() != sql
+
+### Output
+
+def _export(tmpdir, query):
+    playbook = Playbook.load_from_path(data_path('export.yaml'))
+    playbook.update_vars({'out_dir': str(tmpdir)})
+    ctx.playbook = playbook
+    playbook.execute(queries=[query])
+
+def test_export_outputs(tmpdir):
+    _export(tmpdir, 'numbers')
+    assert tmpdir.join('numbers.csv').read() == \
+        'id,name\n1,foo\n2,"bar, baz"\n'
+    assert tmpdir.join('numbers.tsv').read() == '1\tfoo\n2\tbar, baz\n'
+    lines = tmpdir.join('numbers.jsonl').read().splitlines()
+    assert [json.loads(l) for l in lines] == \
+        [{'id': 1, 'name': 'foo'}, {'id': 2, 'name': 'bar, baz'}]
+
+def test_columnar_outputs(tmpdir):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    _export(tmpdir, 'columnar')
+    expected = {'id': [1, 2], 'name': ['foo', 'bar']}
+    table = pq.read_table(str(tmpdir.join('columnar.parquet')))
+    assert table.to_pydict() == expected
+    reader = pa.ipc.open_file(str(tmpdir.join('columnar.feather')))
+    assert reader.read_all().to_pydict() == expected
+
+def test_columnar_null_first_chunk(tmpdir):
+    pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    _export(tmpdir, 'null_first')
+    table = pq.read_table(str(tmpdir.join('null_first.parquet')))
+    assert sorted(table.to_pydict()['id'], key=str) == [2, 3, None]
+
+def test_columnar_failed_export(tmpdir, monkeypatch):
+    pytest.importorskip('pyarrow')
+    from yasql.export import ParquetWriter
+    original = ParquetWriter.write
+    def _write(self, rows):
+        if self.count:
+            raise ValueError('Write failed')
+        original(self, rows)
+    monkeypatch.setattr(ParquetWriter, 'write', _write)
+    with pytest.raises(ValueError):
+        _export(tmpdir, 'failed')
+    assert not tmpdir.join('failed.parquet').exists()
+
+def test_execute_without_formatting(tmpdir, monkeypatch):
+    def _format(sql):
+        raise AssertionError('SQL formatted for execution')
+    monkeypatch.setitem(utils.formatters, 'sqlparse', _format)
+    _export(tmpdir, 'numbers')
+    assert tmpdir.join('numbers.csv').read().startswith('id,name\n')
+
+def test_sql_formatter():
+    playbook = Playbook.load_from_path(data_path('basic.yaml'))
+    ctx.playbook = playbook
+    query = playbook.get_query('test_simple')
+    playbook.config.update({'sql_formatter': 'none'})
+    assert query.render_sql() == query.compile_sql() + ';'
+    playbook.config.update({'sql_formatter': 'string:capwords'})
+    assert query.render_sql() == \
+        string.capwords(query.compile_sql() + ';')
+
+def test_bind_params(tmpdir):
+    playbook = Playbook('''
+config:
+  db_conn: sqlite:///{0}/bind.db
+  bind_params: true
+queries:
+  - name: bound
+    select:
+      fields: [id]
+      from: items
+      where:
+        id: [1, 3]
+    output: {0}/bound.csv
+'''.format(tmpdir))
+    ctx.playbook = playbook
+    engine = playbook.config.db_conn
+    engine.execute('create table items (id int)')
+    engine.execute('insert into items values (1), (2), (3)')
+    executed = []
+    def _before_execute(conn, cursor, statement, params, context, many):
+        executed.append((statement, params))
+    sa.event.listen(engine, 'before_cursor_execute', _before_execute)
+    try:
+        playbook.execute()
+    finally:
+        sa.event.remove(engine, 'before_cursor_execute', _before_execute)
+    assert tmpdir.join('bound.csv').read() == 'id\n1\n3\n'
+    assert executed[-1][1] == (1, 3)
+    assert 'IN (1, 3)' in playbook.get_query('bound').compile_sql()
+
+def test_output_by_extension(tmpdir):
+    _export(tmpdir, 'by_extension')
+    assert tmpdir.join('by_extension.csv').read() == 'id\n1\n'
+
+def _load_foreach_playbook(tmpdir):
+    playbook = Playbook.load_from_path(data_path('foreach.yaml'))
+    playbook.update_vars({'out_dir': str(tmpdir)})
+    playbook.config.update(
+        {'db_conn': 'sqlite:///{}/foreach.db'.format(tmpdir)})
+    engine = playbook.config.db_conn
+    engine.execute('create table items (id int, region text, kind text)')
+    engine.execute("insert into items values (1, 'us', 'a'), (2, 'us', 'b'), "
+                   "(3, 'eu', 'a'), (4, 'us', 'a')")
+    ctx.playbook = playbook
+    return playbook
+
+def test_foreach_bound(tmpdir, monkeypatch):
+    playbook = _load_foreach_playbook(tmpdir)
+    renders = []
+    original = SQLRender.render
+    def _render(self):
+        renders.append(self)
+        return original(self)
+    monkeypatch.setattr(SQLRender, 'render', _render)
+    playbook.execute(queries=['per_region'])
+    assert len(renders) == 1
+    assert tmpdir.join('us_a.csv').read() == 'id\n1\n4\n'
+    assert tmpdir.join('us_b.csv').read() == 'id\n2\n'
+    assert tmpdir.join('eu_a.csv').read() == 'id\n3\n'
+    assert tmpdir.join('eu_b.csv').read() == 'id\n'
+
+def test_foreach_rendered(tmpdir):
+    playbook = _load_foreach_playbook(tmpdir)
+    query = playbook.get_query('per_region_sql')
+    assert not query.is_bound
+    assert [q.name for q in query.foreach_queries()] == \
+        ['per_region_sql[region=us]', 'per_region_sql[region=eu]']
+    playbook.execute(queries=['per_region_sql'])
+    assert tmpdir.join('count_us.csv').read() == 'n\n3\n'
+    assert tmpdir.join('count_eu.csv').read() == 'n\n1\n'
+
+### Watch
+
+WATCH_PLAYBOOK = '''
+imports:
+  - from: lib.yaml
+    import: vars
+queries:
+  - name: a
+    sql: select ${value} as v
+    output: {format: table, name: w_a, mode: replace}
+  - name: b
+    select: {fields: [v], from: w_a}
+    output: {format: table, name: w_b, mode: replace}
+  - name: c
+    sql: select %s as v
+    output: {format: table, name: w_c, mode: replace}
+'''
+
+def _write_file(path, content):
+    path.write(content)
+    # Make sure the modification time changes
+    mtime = path.mtime() + 10
+    os.utime(str(path), (mtime, mtime))
+
+def test_watch(tmpdir):
+    _write_file(tmpdir.join('lib.yaml'), 'vars: {value: 1}')
+    _write_file(tmpdir.join('main.yaml'), WATCH_PLAYBOOK % 1)
+    watcher = Watcher(str(tmpdir.join('main.yaml')), config={
+        'db_conn': 'sqlite:///{}/watch.db'.format(tmpdir)})
+    watcher.start()
+    assert watcher.check() is None
+    query_b = watcher.playbook.get_query('b')
+
+    _write_file(tmpdir.join('main.yaml'), WATCH_PLAYBOOK % 2)
+    assert watcher.check() == ['c']
+    assert watcher.playbook.get_query('b') is query_b
+
+    _write_file(tmpdir.join('lib.yaml'), 'vars: {value: 3}')
+    assert watcher.check() == ['a', 'b']
+    engine = watcher.playbook.config.db_conn
+    assert engine.execute('select v from w_b').fetchall() == [(3,)]
+
+### Preview
+
+def test_preview_sql(tmpdir):
+    playbook = _load_sqlite_playbook(tmpdir, 'preview.yaml')
+    numbers = playbook.get_query('numbers')
+    # SQLite always renders an OFFSET with LIMIT
+    assert_sql_equal(numbers.preview_sql(5),
+                     'SELECT * FROM ({}) AS preview LIMIT 5 OFFSET 0'.format(
+                         numbers.compile_sql().rstrip('; \n')))
+    evens = playbook.get_query('evens')
+    assert 'LIMIT 3 OFFSET' in evens.preview_sql(5)
+    assert 'LIMIT 2 OFFSET' in evens.preview_sql(2)
+    assert_sql_equal(evens.count_sql(),
+                     'SELECT count(*) AS count_1 FROM ({}) AS counted'.format(
+                         evens.compile_sql()))
+
+def test_tablesample():
+    from sqlalchemy.dialects import postgresql
+    statement = SQLRender({'select': {
+        'fields': ['b.id'], 'from': {'b': 'big'}, 'sample': 1}}).render()
+    sql = str(statement.compile(dialect=postgresql.dialect(),
+                                compile_kwargs={'literal_binds': True}))
+    assert_sql_equal(sql, 'SELECT b.id FROM big AS b TABLESAMPLE system(1)')
+
+def test_preview_output(tmpdir, capsys):
+    playbook = _load_sqlite_playbook(tmpdir, 'preview.yaml')
+    ctx.preview = 3
+    try:
+        playbook.execute(queries=['numbers'])
+        out = capsys.readouterr().out
+        assert out.split('\n')[2:6] == \
+            ['  1', '  2', '  3', 'Other rows are not displayed.']
+        assert not utils.table_exists(playbook.config.db_conn,
+                                      'preview_numbers')
+
+        playbook.config.update({'print_count': True})
+        playbook.execute(queries=['numbers'])
+        assert 'Total rows: 10' in capsys.readouterr().out
+    finally:
+        ctx.preview = None
+
+def test_print_total(tmpdir, capsys):
+    playbook = _load_sqlite_playbook(tmpdir, 'preview.yaml')
+    playbook.config.update({'print_max_rows': 4})
+    ctx.print_result = True
+    try:
+        playbook.execute()
+        out = capsys.readouterr().out
+        assert 'Other rows are not displayed.' in out
+        assert 'Total rows: 3' in out
+    finally:
+        ctx.print_result = False
+
+### Timeouts and budgets
+
+def test_query_timeout(tmpdir):
+    playbook = _load_sqlite_playbook(tmpdir, 'limits.yaml',
+                                     out_dir=str(tmpdir))
+    with pytest.raises(utils.QueryTimeout):
+        playbook.execute(queries=['endless'])
+    assert not utils.table_exists(playbook.config.db_conn, 'limits_endless')
+
+    # Playbook-wide timeout, while fetching printed results
+    playbook.config.update({'timeout': 0.2})
+    ctx.print_result = True
+    try:
+        with pytest.raises(utils.QueryTimeout):
+            playbook.execute(queries=['endless_untimed'])
+    finally:
+        ctx.print_result = False
+    assert not utils.watchdogs
+
+def test_interrupt(tmpdir):
+    playbook = _load_sqlite_playbook(tmpdir, 'limits.yaml',
+                                     out_dir=str(tmpdir))
+    ctx.print_result = True
+    timer = threading.Timer(0.2, _thread.interrupt_main)
+    timer.start()
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            playbook.execute(queries=['endless_untimed'])
+    finally:
+        ctx.print_result = False
+    assert not utils.cancelling.is_set()
+    assert not utils.watchdogs
+
+def test_output_budget(tmpdir):
+    playbook = _load_sqlite_playbook(tmpdir, 'limits.yaml',
+                                     out_dir=str(tmpdir))
+    with pytest.raises(utils.BudgetExceeded):
+        playbook.execute(queries=['export'])
+    assert not tmpdir.join('numbers.csv').exists()
+
+    # Only the displayed rows of printed results are charged
+    playbook.config.update({'budget_max_rows': 3, 'print_max_rows': 3})
+    ctx.print_result = True
+    try:
+        playbook.execute(queries=['numbers'])
+        playbook.config.update({'budget_max_bytes': 20})
+        with pytest.raises(utils.BudgetExceeded):
+            playbook.execute(queries=['numbers'])
+    finally:
+        ctx.print_result = False
+
+### Result cache
+
+def test_result_cache(tmpdir, monkeypatch):
+    playbook = Playbook.load_from_path(data_path('export.yaml'))
+    playbook.update_vars({'out_dir': str(tmpdir)})
+    playbook.config.update({'result_cache': {'path': str(tmpdir.join('c'))}})
+    ctx.playbook = playbook
+    playbook.execute(queries=['numbers'])
+    expected = tmpdir.join('numbers.csv').read()
+    tmpdir.join('numbers.csv').remove()
+
+    def _execute_sql(*args, **kwargs):
+        raise AssertionError('Query should be loaded from cache')
+    monkeypatch.setattr('yasql.playbook.execute_sql', _execute_sql)
+    playbook.execute(queries=['numbers'])
+    assert tmpdir.join('numbers.csv').read() == expected
+
+    ctx.refresh_cache = True
+    try:
+        with pytest.raises(AssertionError):
+            playbook.execute(queries=['numbers'])
+    finally:
+        ctx.refresh_cache = False
+
+def test_result_cache_eviction(tmpdir):
+    cache = ResultCache(str(tmpdir), max_size=500)
+    for i in range(10):
+        cache.put(str(i), ['id'], [(j,) for j in range(i * 10)])
+    assert cache.get('9').fetchmany(100) == [(j,) for j in range(90)]
+    assert cache.get('0') is None
+    total = sum(os.path.getsize(str(f)) for f in tmpdir.listdir())
+    assert total <= 500
+
+def test_table_output_modes(tmpdir):
+    playbook = _load_sqlite_playbook(tmpdir, 'incremental.yaml')
+    engine = playbook.config.db_conn
+    engine.execute('create table events (id int, day text)')
+    engine.execute("insert into events values "
+                   "(1, '2018-01-01 00:00:00'), (2, '2018-01-02 00:00:00')")
+    playbook.execute()
+
+    engine.execute("insert into events values "
+                   "(3, '2018-01-02 00:00:00'), (4, '2018-01-03 00:00:00')")
+    playbook.execute()
+
+    def _rows(sql):
+        return [tuple(r) for r in engine.execute(sql)]
+    assert _rows('select day, cnt from daily order by day') == [
+        ('2018-01-01 00:00:00', 1),
+        ('2018-01-02 00:00:00', 2),
+        ('2018-01-03 00:00:00', 1)]
+    assert _rows('select id from latest order by id') == [(1,), (2,), (4,)]
+    assert _rows('select cnt from snapshot') == [(4,)]
+
+### Profiling
+
+def test_profiler():
+    events = []
+    profiler.reset()
+    profiler.enabled = True
+    profiler.add_hook(lambda name, duration, args: events.append(name))
+    try:
+        _test_query('basic.yaml', 'test_with')
+    finally:
+        profiler.enabled = False
+        profiler.hooks = []
+    for phase in ['yaml.load', 'playbook.imports', 'keyword.query_vars',
+                  'sql.render', 'sql.compile', 'sql.format']:
+        assert phase in profiler.stats
+        assert phase in events
+    # test_with and the 2 queries it references
+    assert profiler.stats['sql.render'][0] == 3
+
+### Connections
+
+def test_connections(tmpdir):
+    content = '''
+config:
+  db_conn:
+    url: sqlite://
+    pool_pre_ping: true
+    pool_recycle: 600
+  connections:
+    other: sqlite:///{}/other.db
+queries:
+  - name: q1
+    sql: select 1
+  - name: q2
+    connection: other
+    sql: select 1
+'''.format(tmpdir)
+    playbook1 = Playbook(content)
+    playbook2 = Playbook(content)
+    engine = playbook1.get_query('q1').db_conn
+    assert engine is playbook2.get_query('q1').db_conn
+    assert engine.pool._recycle == 600
+    other = playbook1.get_query('q2').db_conn
+    assert other is not engine
+    assert other.url.database.endswith('other.db')
+    dispose_engines()
+    assert playbook1.get_query('q1').db_conn is not engine
+
+def test_execute_async(tmpdir):
+    pytest.importorskip('aiosqlite')
+    playbook = _load_sqlite_playbook(tmpdir, 'dag.yaml')
+    async def _run():
+        try:
+            await playbook.execute_async(concurrency=2)
+        finally:
+            await dispose_engines_async()
+    asyncio.run(_run())
+    rows = playbook.config.db_conn.execute('select total from dag_total')
+    assert rows.fetchall() == [(30,)]
+
+def test_export_async(tmpdir):
+    pytest.importorskip('aiosqlite')
+    playbook = Playbook.load_from_path(data_path('export.yaml'))
+    playbook.update_vars({'out_dir': str(tmpdir)})
+    ctx.playbook = playbook
+    async def _run():
+        try:
+            await playbook.execute_async(queries=['numbers'])
+        finally:
+            await dispose_engines_async()
+    asyncio.run(_run())
+    assert tmpdir.join('numbers.csv').read() == \
+        'id,name\n1,foo\n2,"bar, baz"\n'
+
+def test_print_async(tmpdir, capsys):
+    pytest.importorskip('aiosqlite')
+    playbook = _load_sqlite_playbook(tmpdir, 'preview.yaml')
+    playbook.config.update({'print_max_rows': 4, 'print_count': True})
+    ctx.print_result = True
+    async def _run():
+        try:
+            await playbook.execute_async(queries=['numbers'])
+        finally:
+            await dispose_engines_async()
+    try:
+        asyncio.run(_run())
+    finally:
+        ctx.print_result = False
+    out = capsys.readouterr().out
+    assert 'Other 6 rows are not displayed.' in out
+    assert 'Total rows: 10' in out
+
+def test_async_url():
+    assert str(async_url('sqlite://')) == 'sqlite+aiosqlite://'
+    assert str(async_url('postgresql+psycopg2://u@h/db')) == \
+        'postgresql+asyncpg://u@h/db'
+    assert str(async_url('postgres://u@h/db')) == 'postgresql+asyncpg://u@h/db'
+    assert str(async_url('mysql+asyncmy://u@h/db')) == 'mysql+asyncmy://u@h/db'
@@ -0,0 +1,151 @@
+import os
+import time
+import zlib
+import pickle
+import hashlib
+import logging
+import threading
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+class CachedCursor(object):
+    """ Cursor-like access to a result loaded from the cache """
+    def __init__(self, keys, rows):
+        self._keys = keys
+        self.rows = rows
+        self.pos = 0
+
+    def keys(self):
+        return self._keys
+
+    @property
+    def rowcount(self):
+        return len(self.rows)
+
+    def fetchmany(self, size):
+        rows = self.rows[self.pos:self.pos + size]
+        self.pos += len(rows)
+        return rows
+
+    def close(self):
+        pass
+
+
+class RecordingCursor(object):
+    """ Wraps a DB cursor and stores the rows fetched through it in the
+    cache once the result has been fully fetched """
+    def __init__(self, cache, key, cursor):
+        self.cache = cache
+        self.key = key
+        self.cursor = cursor
+        self.rows = []
+
+    def keys(self):
+        return self.cursor.keys()
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def fetchmany(self, size):
+        rows = self.cursor.fetchmany(size)
+        if self.rows is not None:
+            self.rows.extend(tuple(r) for r in rows)
+            if len(self.rows) > self.cache.max_rows:
+                # Too large to be cached
+                self.rows = None
+            elif len(rows) < size:
+                self.cache.put(self.key, list(self.keys()), self.rows)
+                self.rows = None
+        return rows
+
+    def close(self):
+        self.cursor.close()
+
+
+class ResultCache(object):
+    """ Query results stored on local disk, keyed on the rendered SQL and
+    the connection URL. Each entry is a zlib-compressed pickle of the
+    result columns. Entries expire after `ttl` seconds, and the least
+    recently used ones are evicted when the cache grows over `max_size`
+    bytes. """
+    def __init__(self, path, ttl=3600, max_size=512 * 1024 ** 2,
+                 max_rows=100000):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(sql, url):
+        content = '{}\n{}'.format(url, sql).encode('utf-8')
+        return hashlib.sha256(content).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key + '.cache')
+
+    def get(self, key):
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.loads(zlib.decompress(f.read()))
+        except (OSError, EOFError, zlib.error, pickle.UnpicklingError):
+            return None
+        if time.time() - entry['created'] > self.ttl:
+            self.remove(path)
+            return None
+        # Bump mtime, which is used as last access time for eviction
+        os.utime(path)
+        rows = list(zip(*entry['columns'])) if entry['columns'] else []
+        return CachedCursor(entry['keys'], rows)
+
+    def put(self, key, keys, rows):
+        entry = {
+            'created': time.time(),
+            'keys': keys,
+            'columns': [list(col) for col in zip(*rows)],
+        }
+        content = zlib.compress(pickle.dumps(entry, pickle.HIGHEST_PROTOCOL))
+        if len(content) > self.max_size:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, self.entry_path(key))
+        self.evict()
+
+    def cursor(self, key, cursor):
+        return RecordingCursor(self, key, cursor)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.path):
+                if not name.endswith('.cache'):
+                    continue
+                path = os.path.join(self.path, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                self.remove(path)
+                total -= size
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            if name.endswith('.cache'):
+                self.remove(os.path.join(self.path, name))
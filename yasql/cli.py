@@ -7,11 +7,15 @@ import logging
 import click
 
 from .context import ctx
+from .config import dispose_engines
 from .playbook import Playbook
+from .profiling import profiler
+from .watch import Watcher
 
 def setup_logger(level):
+    # Logs go to stderr, stdout is kept for exported results
     logging.basicConfig(
-        stream=sys.stdout,
+        stream=sys.stderr,
         level=level,
         format='[%(asctime)s] [%(levelname)s] %(message)s'
     )
@@ -33,6 +37,35 @@ def setup_logger(level):
               help='Print out query results')
 @click.option('-m', '--max-rows', type=int, default=100,
               help='Print out query results')
+@click.option('--preview', type=int,
+              help='Only print the first N rows of each query, which the '
+                   'database computes with LIMIT, no output is written')
+@click.option('--sample', type=float,
+              help='Percentage of the rows of the tables read by --preview, '
+                   'for databases supporting TABLESAMPLE')
+@click.option('--count', is_flag=True,
+              help='Count the rows of printed results with a separate '
+                   'COUNT(*), which Ctrl-C cancels')
+@click.option('--no-cache', is_flag=True,
+              help='Do not use the result cache')
+@click.option('--refresh', is_flag=True,
+              help='Re-execute queries and refresh the result cache')
+@click.option('--force', is_flag=True,
+              help='Rebuild tables that the run manifest reports as up to '
+                   'date')
+@click.option('--profile', type=click.Choice(['summary', 'json', 'chrome']),
+              help='Record time spent in each phase and print a summary, '
+                   'or write it as JSON or as a Chrome trace')
+@click.option('--profile-output', default='yasql-profile.json',
+              help='Output file of --profile json/chrome')
+@click.option('-j', '--jobs', type=int, default=1,
+              help='Number of queries executed in parallel')
+@click.option('--watch', is_flag=True,
+              help='Re-execute changed queries and their dependents when '
+                   'the playbook or its imports change')
+@click.option('--no-explain', is_flag=True,
+              help='Do not query the database for EXPLAIN output in the '
+                   'execution plan of --dry')
 def cli(playbook, **kwargs):
     """ Command-line Tool for executing Yasql """
     if kwargs.get('verbose'):
@@ -42,13 +75,41 @@ def cli(playbook, **kwargs):
     else:
         log_level = logging.INFO
     setup_logger(log_level)
-    playbook = Playbook.load_from_path(playbook)
+    profiler.enabled = bool(kwargs.get('profile'))
+    path = playbook
+    playbook = Playbook.load_from_path(path)
     ctx.playbook = playbook
     ctx.dry = kwargs.get('dry')
     ctx.print_result = kwargs.get('print')
-    ctx.config.update({'print_max_rows': kwargs['max_rows']})
+    ctx.use_cache = not kwargs.get('no_cache')
+    ctx.refresh_cache = kwargs.get('refresh')
+    ctx.force = kwargs.get('force')
+    ctx.preview = kwargs.get('preview')
+    config = {'print_max_rows': kwargs['max_rows'],
+              'print_count': kwargs['count']}
+    if kwargs.get('sample'):
+        config['preview_sample'] = kwargs['sample']
+    ctx.config.update(config)
     queries = kwargs['query'].split(',') if kwargs['query'] else None
-    playbook.execute(queries=queries)
+    if kwargs.get('watch'):
+        try:
+            Watcher(path, queries, kwargs['jobs'], config).run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            dispose_engines()
+        return 0
+    try:
+        if ctx.dry:
+            click.echo(playbook.plan(queries=queries,
+                                     explain=not kwargs['no_explain']))
+        playbook.execute(queries=queries, jobs=kwargs['jobs'])
+    finally:
+        dispose_engines()
+    if kwargs.get('profile') == 'summary':
+        click.echo(profiler.summary(), err=True)
+    elif kwargs.get('profile'):
+        profiler.write(kwargs['profile'], kwargs['profile_output'])
     return 0
 
 def main():
@@ -1,21 +1,99 @@
 import os
+import threading
 
 import yaml
 import pytz
 from dateutil.tz import tzlocal
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+
+from .cache import ResultCache
+from .manifest import RunManifest
+from .utils import freeze, Budget
 
 default_path = os.path.join(os.environ['HOME'], '.yasqlrc')
+
+# Engines shared by all the playbooks loaded in the process
+engines = {}
+engines_lock = threading.Lock()
+
+# Asyncio driver used for each backend, unless the URL of the connection
+# already names an asyncio driver
+async_drivers = {
+    'postgresql': 'asyncpg',
+    'mysql': 'aiomysql',
+    'sqlite': 'aiosqlite',
+}
+backend_aliases = {'postgres': 'postgresql'}
+known_async_drivers = {'asyncpg', 'psycopg', 'aiomysql', 'asyncmy',
+                       'aiosqlite', 'aioodbc'}
+
+def async_url(url):
+    url = make_url(url)
+    backend, _, driver = url.drivername.partition('+')
+    backend = backend_aliases.get(backend, backend)
+    if backend not in async_drivers or driver in known_async_drivers:
+        return url
+    return url.set(drivername='{}+{}'.format(backend, async_drivers[backend]))
+
+def get_engine(conf, is_async=False):
+    """ Engine for a connection setting, which is either a database URL or
+    a mapping with `url` and create_engine options (pool_size,
+    max_overflow, pool_pre_ping, pool_recycle, connect_args, ...) """
+    if isinstance(conf, str):
+        conf = {'url': conf}
+    key = (freeze(conf), is_async)
+    with engines_lock:
+        if key not in engines:
+            options = dict(conf)
+            url = options.pop('url')
+            if is_async:
+                # Requires SQLAlchemy 1.4+
+                from sqlalchemy.ext.asyncio import create_async_engine
+                engines[key] = create_async_engine(async_url(url), **options)
+            else:
+                engines[key] = create_engine(url, **options)
+        return engines[key]
+
+def is_memory_db(engine):
+    """ In-memory SQLite databases are private to each connection, hence
+    to each thread with the default pool """
+    url = engine.url
+    return url.drivername.partition('+')[0] == 'sqlite' and \
+        url.database in (None, '', ':memory:')
+
+def dispose_engines():
+    """ Close the connections of all engines, except asyncio ones which
+    are closed by `dispose_engines_async` """
+    with engines_lock:
+        for key, engine in list(engines.items()):
+            if not key[1]:
+                engine.dispose()
+                del engines[key]
+
+async def dispose_engines_async():
+    with engines_lock:
+        async_engines = [(k, e) for k, e in engines.items() if k[1]]
+        for key, engine in async_engines:
+            del engines[key]
+    for key, engine in async_engines:
+        await engine.dispose()
+
 class Config(object):
     def __init__(self, path=default_path):
         if os.path.exists(path):
             self.data = yaml.load(open(path))
         else:
             self.data = {}
-        self.conn_cache = {}
+        self.version = 0
+        self.lock = threading.Lock()
+        self.result_caches = {}
+        self.manifests = {}
 
     def update(self, conf):
         self.data.update(conf)
+        # Invalidates SQL rendered with the previous settings
+        self.version += 1
 
     @property
     def timezone(self):
@@ -26,9 +104,103 @@ class Config(object):
     def print_max_rows(self):
         return self.data.get('print_max_rows', 2000)
 
+    @property
+    def print_count(self):
+        """ Count the rows of printed results that are not all fetched with
+        a separate COUNT(*) statement """
+        return self.data.get('print_count', False)
+
+    @property
+    def preview_sample(self):
+        """ Percentage of the rows of the tables read by previews, where
+        the database supports TABLESAMPLE """
+        return self.data.get('preview_sample')
+
+    @property
+    def fetch_size(self):
+        return self.data.get('fetch_size', 10000)
+
+    @property
+    def result_cache(self):
+        """ ResultCache configured by `result_cache`, None if disabled """
+        conf = self.data.get('result_cache')
+        if conf is True:
+            conf = {}
+        if conf is None or conf is False or not conf.get('enabled', True):
+            return None
+        key = freeze(conf)
+        with self.lock:
+            if key not in self.result_caches:
+                self.result_caches[key] = ResultCache(
+                    conf.get('path', '~/.yasql/cache'),
+                    ttl=conf.get('ttl', 3600),
+                    max_size=conf.get('max_size', 512 * 1024 ** 2),
+                    max_rows=conf.get('max_rows', 100000))
+            return self.result_caches[key]
+
+    @property
+    def manifest(self):
+        """ RunManifest stored at `manifest` (a path, or true for
+        .yasql-manifest.json in the working directory), None if disabled """
+        path = self.data.get('manifest')
+        if path is True:
+            path = '.yasql-manifest.json'
+        if not path:
+            return None
+        with self.lock:
+            if path not in self.manifests:
+                self.manifests[path] = RunManifest(path)
+            return self.manifests[path]
+
+    @property
+    def sql_formatter(self):
+        """ Formatter of displayed SQL: sqlparse, none or module:function """
+        return self.data.get('sql_formatter', 'sqlparse')
+
+    @property
+    def bind_params(self):
+        """ Execute query results with bound parameters instead of literals """
+        return self.data.get('bind_params', False)
+
+    @property
+    def materialize_threshold(self):
+        """ Queries referenced in `with` by at least this number of queries
+        are materialized into tables, None to only materialize the queries
+        setting `materialize` """
+        return self.data.get('materialize_threshold')
+
+    @property
+    def timeout(self):
+        """ Seconds statements may run before they are cancelled """
+        return self.data.get('timeout')
+
+    def budget(self, budget_max_rows=None, budget_max_bytes=None):
+        """ Budget of the rows and bytes fetched by a print or export
+        output, which fails with BudgetExceeded when it is over. Outputs
+        set it with `budget_max_rows` and `budget_max_bytes`, by default the
+        settings of the same names. Unlike `print_max_rows`, which only
+        truncates what is displayed, a budget is a hard limit. """
+        if budget_max_rows is None:
+            budget_max_rows = self.data.get('budget_max_rows')
+        if budget_max_bytes is None:
+            budget_max_bytes = self.data.get('budget_max_bytes')
+        return Budget(budget_max_rows, budget_max_bytes)
+
+    @property
+    def concurrency(self):
+        return self.data.get('concurrency', 10)
+
     @property
     def db_conn(self):
-        conn = self.data.get('db_conn', 'sqlite://')
-        if not conn in self.conn_cache:
-            self.conn_cache[conn] = create_engine(conn)
-        return self.conn_cache[conn]
+        return self.connection()
+
+    def connection(self, name=None, is_async=False):
+        """ Engine of a connection defined in `connections`, or of the
+        default connection `db_conn` when name is None. With is_async, an
+        asyncio engine using an async driver of the same database. """
+        if name is None:
+            return get_engine(self.data.get('db_conn', 'sqlite://'), is_async)
+        connections = self.data.get('connections', {})
+        if name not in connections:
+            raise Exception('Connection not found: {}'.format(name))
+        return get_engine(connections[name], is_async)
@@ -3,6 +3,15 @@ class Context(object):
         self.playbook = None
         self.dry = False
         self.print_result = False
+        self.use_cache = True
+        self.refresh_cache = False
+        # Rebuild tables even when the run manifest says they are up to date
+        self.force = False
+        # Number of rows printed by previews of the queries, replacing
+        # their outputs
+        self.preview = None
+        # Reference time of relative dates, set once per playbook run
+        self.now = None
 
     @property
     def config(self):
@@ -0,0 +1,139 @@
+import heapq
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+logger = logging.getLogger(__name__)
+
+class CyclicDependency(Exception):
+    pass
+
+class QueryGraph(object):
+    """ Dependency graph between the queries of a playbook.
+
+    A query depends on every query it references in `select.with`, and on
+    the last query listed before it that creates (via `output`) a table it
+    reads in `from` or `join`.
+    """
+    def __init__(self, queries):
+        self.queries = list(queries)
+        self.index = {id(q): i for i, q in enumerate(self.queries)}
+        self.parents = {id(q): [] for q in self.queries}
+        self.children = {id(q): [] for q in self.queries}
+        self._build()
+
+    def _build(self):
+        by_name = {q.name: q for q in self.queries if q.name}
+        producers = {}
+        for q in self.queries:
+            deps = [by_name[n] for n in q.with_queries if n in by_name]
+            deps += [producers[t] for t in q.input_tables if t in producers]
+            for dep in deps:
+                self.add_edge(dep, q)
+            for t in q.output_tables:
+                producers[t] = q
+
+    def add_edge(self, parent, child):
+        if parent is child or parent in self.parents[id(child)]:
+            return
+        self.parents[id(child)].append(parent)
+        self.children[id(parent)].append(child)
+
+    def dependencies(self, query):
+        return list(self.parents[id(query)])
+
+    def dependents(self, query):
+        return list(self.children[id(query)])
+
+    def order(self):
+        """ Topological order, keeping the playbook order whenever possible """
+        remaining = {key: len(p) for key, p in self.parents.items()}
+        ready = [self.index[id(q)] for q in self.queries
+                 if not remaining[id(q)]]
+        heapq.heapify(ready)
+        result = []
+        while ready:
+            q = self.queries[heapq.heappop(ready)]
+            result.append(q)
+            for child in self.children[id(q)]:
+                remaining[id(child)] -= 1
+                if not remaining[id(child)]:
+                    heapq.heappush(ready, self.index[id(child)])
+        if len(result) < len(self.queries):
+            cyclic = [q.name for q in self.queries if remaining[id(q)]]
+            raise CyclicDependency(cyclic)
+        return result
+
+    def stages(self):
+        """ Queries grouped by stage: the queries of a stage only depend on
+        queries of earlier stages, so they can run in parallel """
+        levels = {}
+        for q in self.order():
+            levels[id(q)] = max([levels[id(p)] + 1
+                                 for p in self.parents[id(q)]] or [0])
+        stages = [[] for i in range(max(levels.values(), default=-1) + 1)]
+        for q in self.queries:
+            stages[levels[id(q)]].append(q)
+        return stages
+
+    def run(self, func, jobs=1):
+        """ Call `func` on every query, running up to `jobs` of them at the
+        same time while respecting the dependency order. """
+        if jobs <= 1:
+            for q in self.order():
+                func(q)
+            return
+        # Detect cycles before anything gets executed
+        self.order()
+
+        remaining = {key: len(p) for key, p in self.parents.items()}
+        ready = [self.index[id(q)] for q in self.queries
+                 if not remaining[id(q)]]
+        heapq.heapify(ready)
+        running = {}
+        errors = []
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            while ready or running:
+                while ready and not errors and len(running) < jobs:
+                    q = self.queries[heapq.heappop(ready)]
+                    running[pool.submit(func, q)] = q
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    q = running.pop(future)
+                    error = future.exception()
+                    if error:
+                        logger.error('Query %s failed: %s', q.name, error)
+                        errors.append(error)
+                        continue
+                    for child in self.children[id(q)]:
+                        remaining[id(child)] -= 1
+                        if not remaining[id(child)]:
+                            heapq.heappush(ready, self.index[id(child)])
+        if errors:
+            raise errors[0]
+
+    async def run_async(self, func, concurrency=None):
+        """ Await `func(query)` for every query, running up to `concurrency`
+        of them at the same time while respecting the dependency order. """
+        semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+        tasks = {}
+
+        async def _run(q):
+            parents = [tasks[id(p)] for p in self.parents[id(q)]]
+            if parents:
+                await asyncio.gather(*parents)
+            if semaphore is None:
+                return await func(q)
+            async with semaphore:
+                return await func(q)
+
+        for q in self.order():
+            tasks[id(q)] = asyncio.ensure_future(_run(q))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
@@ -0,0 +1,197 @@
+import os
+import sys
+import csv
+import json
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+
+from .utils import iter_chunks
+
+@contextmanager
+def open_output(path, mode='w'):
+    """ Open `path` for writing, or stdout when no path is given. The file
+    is removed when writing fails, instead of leaving a partial output. """
+    if not path or path == '-':
+        yield sys.stdout.buffer if 'b' in mode else sys.stdout
+        return
+    newline = None if 'b' in mode else ''
+    try:
+        with open(path, mode, newline=newline) as f:
+            yield f
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+
+class Writer(object):
+    """ Writes query results into a file, one chunk of rows at a time """
+    mode = 'w'
+
+    def __init__(self, f, keys):
+        self.f = f
+        self.keys = list(keys)
+        self.count = 0
+
+    def write(self, rows):
+        self.count += len(rows)
+
+    def close(self):
+        """ Finish writing, returns the number of rows written """
+        return self.count
+
+    def abort(self):
+        """ Release the resources of the writer after a failed export """
+
+
+class DelimitedWriter(Writer):
+    delimiter = ','
+
+    def __init__(self, f, keys, header=True):
+        super().__init__(f, keys)
+        self.writer = csv.writer(f, delimiter=self.delimiter,
+                                 lineterminator='\n')
+        if header:
+            self.writer.writerow(self.keys)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        super().write(rows)
+
+
+class CsvWriter(DelimitedWriter):
+    delimiter = ','
+
+
+class TsvWriter(DelimitedWriter):
+    delimiter = '\t'
+
+
+class JsonLinesWriter(Writer):
+    def write(self, rows):
+        self.f.writelines(
+            json.dumps(dict(zip(self.keys, row)), default=str) + '\n'
+            for row in rows)
+        super().write(rows)
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception('pyarrow is required for columnar outputs, '
+                        'install it with `pip install yasql[arrow]`')
+    return pyarrow
+
+
+class ColumnarWriter(Writer, metaclass=ABCMeta):
+    """ Converts chunks of rows into arrow record batches.
+
+    Column types are inferred from the data. Rows are buffered until every
+    column has a non-null value, or `buffer_rows` rows were read, in which
+    case the columns with only NULLs so far are written as strings.
+    """
+    mode = 'wb'
+    buffer_rows = 100000
+
+    def __init__(self, f, keys, compression=None):
+        super().__init__(f, keys)
+        self.pa = import_pyarrow()
+        self.compression = compression
+        self.types = [None] * len(self.keys)
+        self.pending = []
+        self.schema = None
+        self.writer = None
+
+    @abstractmethod
+    def open_writer(self, schema):
+        """ Arrow writer of the file format, for the given schema """
+
+    def infer_types(self, rows):
+        pa = self.pa
+        for i, col in enumerate(zip(*rows)):
+            if self.types[i] is None:
+                type = pa.array(col).type
+                if type != pa.null():
+                    self.types[i] = type
+
+    def open(self, default_type):
+        self.schema = self.pa.schema(
+            [(k, t or default_type) for k, t in zip(self.keys, self.types)])
+        self.writer = self.open_writer(self.schema)
+
+    def to_batch(self, rows):
+        pa = self.pa
+        arrays = []
+        for col, type, field in zip(zip(*rows), self.types, self.schema):
+            if type is None:
+                col = [None if v is None else str(v) for v in col]
+            arrays.append(pa.array(col, type=field.type))
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def flush(self):
+        if self.pending:
+            self.writer.write_batch(self.to_batch(self.pending))
+            self.pending = []
+
+    def write(self, rows):
+        if not rows:
+            return
+        super().write(rows)
+        if self.writer is not None:
+            self.writer.write_batch(self.to_batch(rows))
+            return
+        self.pending.extend(rows)
+        self.infer_types(rows)
+        if None not in self.types or len(self.pending) >= self.buffer_rows:
+            self.open(self.pa.string())
+            self.flush()
+
+    def close(self):
+        if self.writer is None:
+            # Columns without any non-null value are typed as null
+            self.open(self.pa.null())
+            self.flush()
+        self.writer.close()
+        return super().close()
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ParquetWriter(ColumnarWriter):
+    def open_writer(self, schema):
+        return self.pa.parquet.ParquetWriter(
+            self.f, schema, compression=self.compression or 'snappy')
+
+
+class ArrowWriter(ColumnarWriter):
+    """ Arrow IPC file format, which is also Feather v2 """
+    def open_writer(self, schema):
+        options = self.pa.ipc.IpcWriteOptions(compression=self.compression)
+        return self.pa.ipc.new_file(self.f, schema, options=options)
+
+
+writers = {
+    'csv': CsvWriter,
+    'tsv': TsvWriter,
+    'jsonl': JsonLinesWriter,
+    'parquet': ParquetWriter,
+    'arrow': ArrowWriter,
+    'feather': ArrowWriter,
+}
+
+
+def export(cursor, f, writer_cls, chunk_size, budget=None, **options):
+    writer = writer_cls(f, cursor.keys(), **options)
+    try:
+        for rows in iter_chunks(cursor, chunk_size):
+            if budget is not None:
+                budget.consume(rows)
+            writer.write(rows)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close()
@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+import threading
+import tempfile
+from datetime import datetime
+
+class RunManifest(object):
+    """ Record of the tables materialized by previous runs, stored as JSON.
+
+    For each query and each table it outputs, the manifest keeps the hash
+    of the rendered SQL, the builds of its input tables and the time the
+    table was last built. A table is up to date when its SQL has not
+    changed and its input tables have not been rebuilt since, like targets
+    of a build system. Input tables that are not produced by a playbook
+    query are not tracked, changes to their content are not detected.
+    """
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        self.queries = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.queries = json.load(f).get('queries', {})
+        except (OSError, ValueError):
+            self.queries = {}
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'queries': self.queries}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def begin(self):
+        """ Start a new run, reloading entries written by other processes """
+        with self.lock:
+            self.load()
+
+    @classmethod
+    def sql_hash(cls, query):
+        # Queries read from materialized tables are part of the SQL
+        content = '\n'.join([str(query.db_conn.url)] + cls.sources(query))
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def sources(cls, query):
+        sql = [query.compile_sql()]
+        for q in query.materialized_queries():
+            sql += cls.sources(q)
+        return sql
+
+    def table_hash(self, name):
+        """ Hash of the last build of a table, None if it is not tracked """
+        entries = [tables[name] for tables in self.queries.values()
+                   if name in tables]
+        if not entries:
+            return None
+        return max(entries, key=lambda e: e['completed'])['hash']
+
+    def state(self, query):
+        """ (sql_hash, inputs) of a query in its current state """
+        inputs = {t: self.table_hash(t) for t in query.input_tables}
+        return self.sql_hash(query), inputs
+
+    def is_up_to_date(self, query, name, exists):
+        """ Whether table `name` was last built by `query` with the same SQL
+        and the same builds of its inputs. `exists` is called to check the
+        table is still in the database. """
+        with self.lock:
+            entry = self.queries.get(query.name, {}).get(name)
+            if not entry:
+                return False
+            sql_hash, inputs = self.state(query)
+        if entry['sql_hash'] != sql_hash or entry['inputs'] != inputs:
+            return False
+        return exists()
+
+    def record(self, query, name):
+        """ Record a successful build of table `name` by `query` """
+        with self.lock:
+            sql_hash, inputs = self.state(query)
+            completed = datetime.now().isoformat()
+            # Identifies this build, dependent tables are rebuilt when it
+            # changes
+            content = json.dumps([name, sql_hash, inputs, completed],
+                                 sort_keys=True)
+            self.queries.setdefault(query.name, {})[name] = {
+                'sql_hash': sql_hash,
+                'inputs': inputs,
+                'hash': hashlib.sha256(content.encode('utf-8')).hexdigest(),
+                'completed': completed,
+            }
+            self.save()
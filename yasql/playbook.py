@@ -1,20 +1,34 @@
 import os
 import re
 import copy
+import asyncio
 import logging
-from collections import Counter
+import itertools
+import threading
+from datetime import datetime
+from collections import OrderedDict, Counter
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import indent
 
-from funcy import cached_property, merge, omit
-from tabulate import tabulate
+import sqlalchemy as sa
+from sqlalchemy.sql.expression import TextAsFrom
+from funcy import cached_property, merge, omit, distinct
 
 from .base import dict_cls
-from .config import Config
-from .yaml_parser import load
+from .config import Config, is_memory_db
+from .yaml_parser import load, load_file
 from .sql_render import SQLRender
+from .export import writers, open_output, export
 from .context import ctx
+from .profiling import profiler
+from .dag import QueryGraph, CyclicDependency
+from .syntax.clause import referenced_tables, build_condition
+from .syntax.datetime import is_dt_expr
 from .utils import sql_format, overrides, inject_vars, listify, dict_one, \
-    execute_sql
+    execute_sql, execute_transaction, table_exists, freeze, log_sql, \
+    driver_text, execute_transaction_async, table_exists_async, iter_chunks, \
+    single_var_re, explain_sql, run_interruptible, QueryTimeout
 
 logger = logging.getLogger(__name__)
 
@@ -27,14 +41,18 @@ class QueryNotExists(Exception):
 def query_select_with(query, data):
     def _process_one(item):
         if isinstance(item, str):
-            alias = item
-            sql = playbook.get_query(item).render_sql()
-            return dict_cls({item: sql})
+            alias = subquery = item
         elif isinstance(item, dict_cls):
             alias, subquery = dict_one(item)
-            sql = playbook.get_query(subquery).render_sql()
         else:
             raise Exception("Invalid format in with: {}".format(item))
+        query._with_queries.append(subquery)
+        referenced = playbook.get_query(subquery)
+        if query.reads_materialized(referenced, data):
+            # Read from the table the query is materialized into
+            return dict_cls({alias: dict_cls(
+                {'table': referenced.materialized_table})})
+        sql = referenced.compile_sql()
         return dict_cls({alias: re.sub(';$', '', sql)})
 
     playbook = query.playbook
@@ -44,18 +62,72 @@ def query_select_with(query, data):
 
     select_with = listify(select_with)
     select_with = [_process_one(item) for item in select_with]
-    data['select']['with'] = select_with
-
-    return data
+    return merge(data, {'select': merge(data['select'],
+                                        {'with': select_with})})
 
 
 def query_vars(query, data):
     playbook_vars = query.playbook.get('vars', {})
     query_vars = data.get('vars', {})
-    vars = overrides(playbook_vars, query_vars)
-    if vars:
-        data = inject_vars(data, vars)
-    return data
+    vars = overrides(playbook_vars, query_vars, query.foreach_vars(data))
+    if not vars:
+        return data
+    if query.is_bound:
+        # Outputs are rendered for each binding, see BoundQuery
+        output = data.get('output')
+        data = inject_vars(omit(data, 'output'), vars)
+        return merge(data, {'output': output}) if output else data
+    return inject_vars(data, vars)
+
+def can_bind_vars(data, bindings):
+    """ Whether the vars of `bindings` can be bound parameters of the
+    query: they are only used as whole values of `where` conditions (e.g.
+    `region: ${region}`), and their values are neither lists nor datetime
+    expressions """
+    names = list(bindings[0])
+    refs = {n: re.compile(r'\$\{[^}]*\b%s\b' % re.escape(n)) for n in names}
+    unbindable = set()
+
+    def _walk(item, is_value=False):
+        if isinstance(item, str):
+            match = single_var_re.match(item.strip())
+            for name, ref in refs.items():
+                if ref.search(item) and \
+                        not (is_value and match and match.group(1) == name):
+                    unbindable.add(name)
+        elif isinstance(item, list):
+            for i in item:
+                _walk(i, is_value)
+        elif isinstance(item, dict):
+            for v in item.values():
+                _walk(v)
+
+    def _walk_where(cond):
+        if isinstance(cond, list):
+            for c in cond:
+                _walk_where(c)
+        elif isinstance(cond, dict):
+            for col, val in cond.items():
+                if col == 'or_':
+                    _walk_where(val)
+                else:
+                    _walk(val, is_value=True)
+        else:
+            _walk(cond)
+
+    for key, val in data.items():
+        if key == 'select':
+            _walk(omit(val, 'where'))
+            _walk_where(val.get('where', []))
+        elif key not in ('name', 'doc', 'output', 'foreach'):
+            _walk(val)
+    for binding in bindings:
+        for name, val in binding.items():
+            if isinstance(val, (list, dict)) or \
+                    type(val) is not type(bindings[0][name]) or \
+                    (isinstance(val, str) and is_dt_expr(val)):
+                unbindable.add(name)
+    return not unbindable
 
 
 def query_template(query, data):
@@ -63,45 +135,400 @@ def query_template(query, data):
         return data
 
     templates = query.playbook.get('templates', {})
-    tmpl_path = data.pop('template')
+    tmpl_path = data['template']
     tmpl = templates.get_path(tmpl_path)
     if not tmpl:
         raise Exception('Template not found: {}'.format(tmpl_path))
-    return merge(data, tmpl)
+    return merge(omit(data, 'template'), tmpl)
 
 def query_output(query, data):
+    def _normalize(item):
+        # A string is either a file path with a known export extension
+        # (e.g. result.parquet) or a table name
+        if isinstance(item, str):
+            ext = os.path.splitext(item)[1][1:]
+            if ext in writers:
+                return {'format': ext, 'path': item}
+            return {'format': 'table', 'name': item}
+        return item
+
     out = data.get('output', [])
-    if isinstance(out, str):
-        out = [{'format': 'table', 'name': out}]
-    elif isinstance(out, dict_cls):
+    if isinstance(out, (str, dict_cls)):
         out = [out]
-    if ctx.print_result:
-        out.insert(0, {'format': 'print'})
-    print(out)
+    out = [_normalize(item) for item in out]
+    if ctx.preview:
+        # Previews replace the outputs, no table or file is written
+        out = [{'format': 'preview'}]
+    elif ctx.print_result:
+        out = [{'format': 'print'}] + out
     return merge(data, {'output': out})
 
 
-def output_table(query, name):
-    sql = query.render_sql()
-    sql = 'CREATE TABLE {} AS \n{}'.format(name, query.render_sql())
-    result = execute_sql(query.db_conn, sql)
-    logger.info('Table %s was created from query %s', name, query.name)
+def is_up_to_date(query, name, mode, exists):
+    """ Whether the run manifest allows skipping the materialization of
+    table `name`. Incremental tables are always updated. """
+    manifest = query.playbook.config.manifest
+    if manifest is None or ctx.force or mode == 'incremental':
+        return False
+    return manifest.is_up_to_date(query, name, exists)
+
+def record_build(query, name):
+    manifest = query.playbook.config.manifest
+    if manifest is not None and not ctx.dry:
+        manifest.record(query, name)
+
+def output_table(query, name, mode='create', key=None, since=None):
+    """ Materialize query results into a table.
+
+    mode can be:
+    - create: CREATE TABLE AS the query (default)
+    - replace: create a temporary table, then swap it with the existing one
+    - incremental: insert into the existing table only the rows whose `key`
+      column is within `since` (a datetime expression, e.g. `since
+      yesterday`, rows in that range are deleted first), or greater than
+      the current maximum of `key` when `since` is not set.
+    """
+    engine = query.db_conn
+    if is_up_to_date(query, name, mode, lambda: table_exists(engine, name)):
+        logger.info('Table %s is up to date, skipped', name)
+        return
+    exists = mode == 'incremental' and table_exists(engine, name)
+    statements, message = table_statements(query, name, mode, key, since,
+                                           exists)
+    result = execute_transaction(engine, statements, timeout=query.timeout)
+    logger.info(message, name, query.name)
+    record_build(query, name)
     return result
 
-def output_print(query):
-    sql = query.render_sql()
-    cursor = execute_sql(query.db_conn, sql)
-    rows = cursor.fetchmany(ctx.config.print_max_rows)
+def materialize_statements(query):
+    """ Statements creating the table a query is materialized into """
+    table = query.materialized_table
+    return ['DROP TABLE IF EXISTS {}'.format(table),
+            'CREATE TABLE {} AS \n{}'.format(table, query.compile_sql())]
+
+def table_statements(query, name, mode, key, since, exists):
+    """ Statements materializing a table output, and the log message """
+    sql = query.compile_sql()
+    if mode == 'incremental' and exists:
+        return (incremental_statements(query, name, sql, key, since),
+                'Table %s was incrementally updated from query %s')
+    elif mode == 'replace':
+        tmp_name = name + '__yasql_tmp'
+        return ([
+            'DROP TABLE IF EXISTS {}'.format(tmp_name),
+            'CREATE TABLE {} AS \n{}'.format(tmp_name, sql),
+            'DROP TABLE IF EXISTS {}'.format(name),
+            'ALTER TABLE {} RENAME TO {}'.format(
+                tmp_name, name.rpartition('.')[2]),
+        ], 'Table %s was replaced from query %s')
+    elif mode not in ('create', 'incremental'):
+        raise Exception('Table output mode not supported: {}'.format(mode))
+    return (['CREATE TABLE {} AS \n{}'.format(name, sql)],
+            'Table %s was created from query %s')
+
+def incremental_statements(query, name, sql, key, since):
+    if not key:
+        raise Exception('Incremental table output requires a key: {}'.format(
+            name))
+    new_rows = TextAsFrom(sa.text(re.sub(';$', '', sql)), []).alias('new_rows')
+    if since:
+        if not is_dt_expr(since):
+            since = 'dt | ' + since
+        cond = build_condition(dict_cls({key: since}))
+    else:
+        latest = '(SELECT MAX({}) FROM {})'.format(key, name)
+        cond = sa.text('{key} > {latest} OR {latest} IS NULL'.format(
+            key=key, latest=latest))
+
+    def _compile(stmt):
+        return str(stmt.compile(query.db_conn,
+                                compile_kwargs={"literal_binds": True}))
+
+    statements = []
+    if since:
+        statements.append('DELETE FROM {} WHERE {}'.format(
+            name, _compile(cond)))
+    select = sa.select([sa.text('*')]).select_from(new_rows).where(cond)
+    statements.append('INSERT INTO {} \n{}'.format(name, _compile(select)))
+    return statements
+
+def fetch_results(query, stream=False):
+    """ Execute a query for its results, going through the result cache
+    when it is enabled """
+    if ctx.dry:
+        return log_sql(query.compile_sql())
+    cache = ctx.config.result_cache if ctx.use_cache else None
+    if cache is None:
+        return execute_sql(query.db_conn, query.executable(), stream=stream,
+                           timeout=query.timeout)
+    key = cache.key(query.compile_sql(), str(query.db_conn.url))
+    if not ctx.refresh_cache:
+        cursor = cache.get(key)
+        if cursor is not None:
+            logger.info('Results of query %s loaded from cache', query.name)
+            return cursor
+    return cache.cursor(key, execute_sql(query.db_conn, query.executable(),
+                                         stream=stream,
+                                         timeout=query.timeout))
+
+def output_print(query, budget_max_rows=None, budget_max_bytes=None):
+    cursor = fetch_results(query)
+    if cursor is None:
+        return
+    budget = ctx.config.budget(budget_max_rows, budget_max_bytes)
+    max_rows = ctx.config.print_max_rows
+    try:
+        with profiler.phase('db.fetch'):
+            # One more row tells whether results are truncated
+            rows = cursor.fetchmany(max_rows + 1)
+        # Only the displayed rows are charged
+        budget.consume(rows[:max_rows])
+        keys = list(cursor.keys())
+    finally:
+        cursor.close()
+    print_first_rows(query, keys, rows, max_rows)
+
+def output_preview(query):
+    """ Print the first `ctx.preview` rows of the query. The database only
+    computes these rows (LIMIT), from a sample of the tables read when
+    `preview_sample` is set and the database supports TABLESAMPLE. """
+    sql = query.preview_sql(ctx.preview + 1)
+    if ctx.dry:
+        return log_sql(sql)
+    cursor = execute_sql(query.db_conn, sql, timeout=query.timeout)
+    try:
+        with profiler.phase('db.fetch'):
+            keys, rows = list(cursor.keys()), cursor.fetchall()
+    finally:
+        cursor.close()
+    print_first_rows(query, keys, rows, ctx.preview,
+                     complete=preview_sample(query) is None)
+
+def print_first_rows(query, keys, rows, max_rows, complete=True):
+    """ Print up to `max_rows` of `rows`, which were fetched with one more
+    row to tell whether they are truncated. The total row count is known
+    when they are not and `complete` (not sampled), otherwise it is only
+    reported with `print_count`, by a separate COUNT(*) statement. """
+    total = len(rows) if complete and len(rows) <= max_rows else None
+    if total is None and ctx.config.print_count:
+        total = count_rows(query)
+    print_rows(query, keys, rows[:max_rows], total)
+
+def count_rows(query):
+    """ Row count of the results of a query, None when the COUNT(*)
+    statement is cancelled with Ctrl-C """
+    engine = query.db_conn
+    def _count():
+        with engine.connect() as conn:
+            cursor = execute_sql(conn, query.count_sql(),
+                                 timeout=query.timeout)
+            return cursor.fetchall()[0][0]
+    try:
+        if is_memory_db(engine):
+            return _count()
+        return run_interruptible(_count)
+    except KeyboardInterrupt:
+        logger.warning('Row count of query %s was cancelled', query.name)
+        return None
+
+def print_rows(query, keys, rows, total):
+    """ `total` is the row count of the results, None when unknown """
+    from tabulate import tabulate
+    profiler.count_rows(query.name, len(rows))
     if len(rows) > 0:
-        print(tabulate(rows, headers=rows[0].keys()))
-        if cursor.rowcount > len(rows):
-            remaining_count = cursor.rowcount - len(rows)
+        print(tabulate([tuple(r) for r in rows], headers=keys))
+        if total is None:
+            print('Other rows are not displayed.')
+            return
+        if total > len(rows):
+            remaining_count = total - len(rows)
             print('Other {} rows are not displayed.'.format(remaining_count))
-        print('Total rows: {}'.format(cursor.rowcount))
+        print('Total rows: {}'.format(total))
     else:
         print('0 rows')
 
 
+def output_export(query, format, path=None, chunk_size=None,
+                  budget_max_rows=None, budget_max_bytes=None, **options):
+    """ Stream query results into a file (or stdout) chunk by chunk """
+    cursor = fetch_results(query, stream=True)
+    if cursor is None:
+        return
+    chunk_size = chunk_size or ctx.config.fetch_size
+    writer_cls = writers[format]
+    budget = ctx.config.budget(budget_max_rows, budget_max_bytes)
+    try:
+        with open_output(path, writer_cls.mode) as f:
+            count = export(cursor, f, writer_cls, chunk_size, budget,
+                           **options)
+    finally:
+        cursor.close()
+    profiler.count_rows(query.name, count)
+    logger.info('%s rows of query %s were written to %s',
+                count, query.name, path or 'stdout')
+    return count
+
+
+async def output_table_async(query, name, mode='create', key=None,
+                             since=None):
+    engine = query.async_db_conn
+    # The manifest checks existence with the sync engine of the connection
+    if is_up_to_date(query, name, mode,
+                     lambda: table_exists(query.db_conn, name)):
+        logger.info('Table %s is up to date, skipped', name)
+        return
+    exists = mode == 'incremental' and \
+        await table_exists_async(engine, name)
+    statements, message = table_statements(query, name, mode, key, since,
+                                           exists)
+    await execute_transaction_async(engine, statements)
+    logger.info(message, name, query.name)
+    record_build(query, name)
+
+async def fetch_chunks_async(query, chunk_size):
+    """ Async counterpart of fetch_results: yields (keys, rows) chunks of
+    the results, the first chunk being empty so that keys are known even
+    for empty results. Goes through the result cache when it is enabled. """
+    cache = ctx.config.result_cache if ctx.use_cache else None
+    if cache is not None:
+        key = cache.key(query.compile_sql(), str(query.db_conn.url))
+        if not ctx.refresh_cache:
+            cursor = cache.get(key)
+            if cursor is not None:
+                logger.info('Results of query %s loaded from cache',
+                            query.name)
+                keys = list(cursor.keys())
+                yield keys, []
+                for rows in iter_chunks(cursor, chunk_size):
+                    yield keys, rows
+                return
+
+    recorded = [] if cache is not None else None
+    async with query.async_db_conn.connect() as conn:
+        with profiler.phase('db.execute'):
+            result = await conn.stream(query.executable(async_=True))
+        keys = list(result.keys())
+        yield keys, []
+        async for rows in result.partitions(chunk_size):
+            if recorded is not None:
+                recorded.extend(tuple(r) for r in rows)
+                if len(recorded) > cache.max_rows:
+                    recorded = None
+            yield keys, rows
+    if recorded is not None:
+        cache.put(key, keys, recorded)
+
+async def output_print_async(query, budget_max_rows=None,
+                             budget_max_bytes=None):
+    if ctx.dry:
+        return log_sql(query.compile_sql())
+    budget = ctx.config.budget(budget_max_rows, budget_max_bytes)
+    max_rows = ctx.config.print_max_rows
+    rows = []
+    # As in output_print, one more row tells whether results are truncated
+    chunks = fetch_chunks_async(query, min(ctx.config.fetch_size,
+                                           max_rows + 1))
+    try:
+        async for keys, chunk in chunks:
+            rows.extend(chunk[:max_rows + 1 - len(rows)])
+            if len(rows) > max_rows:
+                break
+    finally:
+        await chunks.aclose()
+    # Only the displayed rows are charged
+    budget.consume(rows[:max_rows])
+    total = len(rows) if len(rows) <= max_rows else None
+    if total is None and ctx.config.print_count:
+        total = await count_rows_async(query)
+    print_rows(query, keys, rows[:max_rows], total)
+
+async def count_rows_async(query):
+    """ Row count of the results of a query by a separate COUNT(*)
+    statement, cancelled with the task running the query """
+    async with query.async_db_conn.connect() as conn:
+        with profiler.phase('db.execute'):
+            result = await conn.execute(driver_text(query.count_sql()))
+        return result.scalar()
+
+async def output_preview_async(query):
+    sql = query.preview_sql(ctx.preview + 1)
+    if ctx.dry:
+        return log_sql(sql)
+    async with query.async_db_conn.connect() as conn:
+        with profiler.phase('db.execute'):
+            result = await conn.execute(driver_text(sql))
+        keys, rows = list(result.keys()), result.fetchall()
+    total = None
+    if preview_sample(query) is None and len(rows) <= ctx.preview:
+        total = len(rows)
+    elif ctx.config.print_count:
+        total = await count_rows_async(query)
+    print_rows(query, keys, rows[:ctx.preview], total)
+
+async def output_export_async(query, format, path=None, chunk_size=None,
+                              budget_max_rows=None, budget_max_bytes=None,
+                              **options):
+    if ctx.dry:
+        return log_sql(query.compile_sql())
+    chunk_size = chunk_size or ctx.config.fetch_size
+    writer_cls = writers[format]
+    budget = ctx.config.budget(budget_max_rows, budget_max_bytes)
+    writer = None
+    with open_output(path, writer_cls.mode) as f:
+        try:
+            async for keys, rows in fetch_chunks_async(query, chunk_size):
+                budget.consume(rows)
+                if writer is None:
+                    writer = writer_cls(f, keys, **options)
+                writer.write(rows)
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            raise
+        count = writer.close()
+    profiler.count_rows(query.name, count)
+    logger.info('%s rows of query %s were written to %s',
+                count, query.name, path or 'stdout')
+    return count
+
+
+def has_dt_expr(item):
+    if isinstance(item, str):
+        return is_dt_expr(item)
+    elif isinstance(item, dict):
+        return any(has_dt_expr(v) for v in item.values())
+    elif isinstance(item, list):
+        return any(has_dt_expr(i) for i in item)
+    return False
+
+# Dialects whose TABLESAMPLE clause takes a percentage of rows
+tablesample_dialects = {'postgresql', 'snowflake'}
+
+def preview_sample(query):
+    """ Percentage of the rows of its tables read by the preview of a
+    query, None when the whole tables are read """
+    sample = query.playbook.config.preview_sample
+    if not sample or 'select' not in query.data or \
+            query.db_conn.dialect.name not in tablesample_dialects:
+        return None
+    return sample
+
+def as_subquery(statement, name):
+    if isinstance(statement, sa.sql.Select):
+        return statement.subquery(name)
+    # Textual SQL, which can't end with a semicolon within a subquery
+    sql = re.sub(r';\s*$', '', statement.text)
+    return sa.text(sql).columns().subquery(name)
+
+def limit_statement(statement, rows):
+    """ `statement` limited to its first `rows` rows """
+    if isinstance(statement, sa.sql.Select):
+        if statement._limit is not None:
+            rows = min(rows, statement._limit)
+        return statement.limit(rows)
+    return sa.select(sa.literal_column('*')).select_from(
+        as_subquery(statement, 'preview')).limit(rows)
+
 class Query(object):
     keywords = [
         query_template,
@@ -112,70 +539,414 @@ class Query(object):
 
     output_formats = {
         'table': output_table,
-        'print': output_print
+        'print': output_print,
+        'preview': output_preview,
+        'csv': partial(output_export, format='csv'),
+        'tsv': partial(output_export, format='tsv'),
+        'jsonl': partial(output_export, format='jsonl'),
+        'parquet': partial(output_export, format='parquet'),
+        'arrow': partial(output_export, format='arrow'),
+        'feather': partial(output_export, format='feather'),
     }
 
-    def __init__(self, data, playbook):
+    async_output_formats = {
+        'table': output_table_async,
+        'print': output_print_async,
+        'preview': output_preview_async,
+        'csv': partial(output_export_async, format='csv'),
+        'tsv': partial(output_export_async, format='tsv'),
+        'jsonl': partial(output_export_async, format='jsonl'),
+        'parquet': partial(output_export_async, format='parquet'),
+        'arrow': partial(output_export_async, format='arrow'),
+        'feather': partial(output_export_async, format='feather'),
+    }
+
+    def __init__(self, data, playbook, binding=None):
+        # Keywords are processed lazily, the first time the query data is
+        # needed, so that only the queries being executed and the queries
+        # they depend on get processed.
         self.name = data.get('name')
         self.playbook = playbook
-        self.data = self.process_keywords(data)
+        self.raw_data = data
+        # Values of the `foreach` vars, for the queries of each binding
+        self.binding = binding
+        self.sql_cache = {}
+        self._data = None
+        self._with_queries = []
+        self._foreach_queries = None
+        self.is_bound = False
+        self._processing = False
+
+    def process(self):
+        if self._processing:
+            raise CyclicDependency([self.name])
+        self._processing = True
+        try:
+            self._with_queries = []
+            self.is_bound = False
+            self._data = self.process_keywords(self.raw_data)
+        finally:
+            self._processing = False
+
+    def invalidate(self):
+        """ Drop processed data and rendered SQL, e.g. after vars changed.
+        They are rebuilt the next time the query is used. """
+        self._data = None
+        self._foreach_queries = None
+        self.sql_cache.clear()
+
+    @property
+    def data(self):
+        if self._data is None:
+            self.process()
+        return self._data
+
+    @property
+    def with_queries(self):
+        """ Names of the queries referenced in `select.with` """
+        self.data
+        return self._with_queries
+
+    @property
+    def is_foreach(self):
+        return self.binding is None and bool(self.raw_data.get('foreach'))
+
+    def bindings(self):
+        """ Every combination of the values of the vars listed in
+        `foreach` """
+        if not self.is_foreach:
+            return []
+        foreach = inject_vars(self.raw_data['foreach'],
+                              self.playbook.get('vars', {}))
+        values = [v if isinstance(v, list) else [v] for v in foreach.values()]
+        return [dict_cls(zip(foreach, combo))
+                for combo in itertools.product(*values)]
+
+    def foreach_vars(self, data):
+        """ Vars of `foreach` when processing the query: bound parameters
+        when they can all be bound, otherwise the first binding, which is
+        used to display the query """
+        if self.binding is not None:
+            return self.binding
+        bindings = self.bindings()
+        if not bindings:
+            return {}
+        self.is_bound = can_bind_vars(data, bindings)
+        if self.is_bound:
+            # Values of the first binding are the defaults, which also
+            # give the types of the parameters
+            return dict_cls((n, sa.bindparam(n, v))
+                            for n, v in bindings[0].items())
+        return bindings[0]
+
+    def foreach_queries(self):
+        """ A query for each binding of the vars of `foreach`. When the vars
+        can be bound parameters, they share the statement of this query,
+        otherwise each one is processed with its values. """
+        if self._foreach_queries is None:
+            self.data
+            if self.is_bound:
+                queries = [BoundQuery(self, b) for b in self.bindings()]
+            else:
+                data = omit(self.raw_data, 'foreach')
+                queries = [Query(data, self.playbook, binding=b)
+                           for b in self.bindings()]
+                for q in queries:
+                    q.name = binding_name(self.name, q.binding)
+            self._foreach_queries = queries
+        return self._foreach_queries
 
     def process_keywords(self, data):
         for kw in self.keywords:
-            data = kw(self, data)
+            with profiler.phase('keyword.' + kw.__name__, query=self.name):
+                data = kw(self, data)
         return data
 
+    def cache_key(self, kind):
+        return (kind, freeze(self.data), self.db_conn.dialect.name,
+                self.playbook.config.version)
+
+    @property
+    def uses_dt_expr(self):
+        """ Whether the SQL of the query depends on the time of the run,
+        through datetime expressions of the query or of the queries it
+        references in `with` """
+        return has_dt_expr(self.data) or any(
+            self.playbook.get_query(name).uses_dt_expr
+            for name in self.with_queries)
+
+    def statement(self):
+        """ SQLAlchemy statement of the query, values are bound parameters """
+        key = self.cache_key('statement')
+        if key not in self.sql_cache:
+            self.sql_cache[key] = SQLRender(self.data).render()
+        return self.sql_cache[key]
+
+    def compile_sql(self):
+        """ SQL of the query compiled for its database, with values
+        rendered as literals """
+        key = self.cache_key('sql')
+        sql = self.sql_cache.get(key)
+        if sql is None:
+            sql = self.sql_cache[key] = self.compile(self.statement())
+        return sql
+
+    def compile(self, statement):
+        with profiler.phase('sql.compile', query=self.name):
+            return str(statement.compile(
+                self.db_conn, compile_kwargs={"literal_binds": True}))
+
+    def preview_statement(self, rows):
+        """ Statement of the first `rows` rows of the query, reading a
+        sample of its tables with `preview_sample` """
+        sample = preview_sample(self)
+        if sample is None:
+            statement = self.statement()
+        else:
+            select = merge(self.data['select'], {'sample': sample})
+            data = merge(self.data, {'select': select})
+            statement = SQLRender(data).render()
+        return limit_statement(statement, rows)
+
+    def preview_sql(self, rows):
+        return self.compile(self.preview_statement(rows))
+
+    def count_sql(self):
+        """ SQL of the row count of the results of the query """
+        return self.compile(sa.select(sa.func.count()).select_from(
+            as_subquery(self.statement(), 'counted')))
+
+    def executable(self, async_=False):
+        """ What is executed for the results of the query: the statement
+        with bound parameters when `bind_params` is set, so that drivers and
+        databases can reuse prepared statements and plans, otherwise the
+        compiled SQL """
+        if self.playbook.config.bind_params:
+            return self.statement()
+        sql = self.compile_sql()
+        return driver_text(sql) if async_ else sql
+
     def render_sql(self):
-        query = SQLRender(self.data).render()
-        query = str(query.compile(self.db_conn,
-                                  compile_kwargs={"literal_binds": True}))
-        return sql_format(query)
+        """ Compiled SQL of the query, formatted for display """
+        sql = self.compile_sql()
+        key = ('formatted', sql, self.playbook.config.sql_formatter)
+        if key not in self.sql_cache:
+            self.sql_cache[key] = sql_format(sql, key[2])
+        return self.sql_cache[key]
 
-    def output(self):
-        outs = self.data.get('output')
-        for out in outs:
+    def outputs(self, formats):
+        """ (output function, kwargs) of each output of the query """
+        for out in self.data.get('output'):
             format = out.get('format')
-            kwargs = omit(out, 'format')
-            if format not in self.output_formats:
+            if format not in formats:
                 raise Exception('Output not supported: {}'.format(format))
-            self.output_formats.get(format)(self, **kwargs)
+            yield formats[format], omit(out, 'format')
+
+    def output(self):
+        for func, kwargs in self.outputs(self.output_formats):
+            func(self, **kwargs)
+
+    async def output_async(self):
+        await asyncio.gather(*[
+            func(self, **kwargs)
+            for func, kwargs in self.outputs(self.async_output_formats)])
 
     def has_output(self):
-        return ctx.print_result or bool(self.data.get('output'))
+        return ctx.print_result or bool(ctx.preview) or \
+            bool(self.data.get('output'))
 
     def execute(self):
+        with profiler.phase('query.execute', query=self.name):
+            if self.is_foreach:
+                return self.execute_foreach()
+            return self._execute()
+
+    def execute_foreach(self):
+        queries = self.foreach_queries()
+        logger.info('Execute query %s for %s bindings', self.name,
+                    len(queries))
+        jobs = self.data.get('jobs', 1)
+        if jobs <= 1 or is_memory_db(self.db_conn):
+            for q in queries:
+                q.execute()
+            return
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            list(pool.map(lambda q: q.execute(), queries))
+
+    async def execute_foreach_async(self):
+        queries = self.foreach_queries()
+        logger.info('Execute query %s for %s bindings', self.name,
+                    len(queries))
+        semaphore = asyncio.Semaphore(self.data.get('jobs', 1))
+
+        async def _run(q):
+            async with semaphore:
+                await q.execute_async()
+        await asyncio.gather(*[_run(q) for q in queries])
+
+    def _execute(self):
         logger.info('Execute query %s', self.name)
         if not self.has_output():
             logger.info("This queries doesn't have any output, "
                         "No commands will be executed.")
-            logger.debug('SQL:\n%s', indent(self.render_sql(), '    '))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('SQL:\n%s', indent(self.render_sql(), '    '))
         else:
+            self.playbook.materialize(self)
             return self.output()
 
+    async def execute_async(self):
+        if self.is_foreach:
+            with profiler.phase('query.execute', query=self.name):
+                return await self.execute_foreach_async()
+        with profiler.phase('query.execute', query=self.name):
+            logger.info('Execute query %s', self.name)
+            if not self.has_output():
+                logger.info("This queries doesn't have any output, "
+                            "No commands will be executed.")
+                return
+            await self.playbook.materialize_async(self)
+            if not self.timeout:
+                await self.output_async()
+            else:
+                # Cancelling the task cancels the statements of asyncio
+                # drivers
+                try:
+                    await asyncio.wait_for(self.output_async(), self.timeout)
+                except asyncio.TimeoutError:
+                    raise QueryTimeout('Query {} cancelled after {} '
+                                       'seconds'.format(self.name,
+                                                        self.timeout))
+
     @property
     def doc(self):
         return self.data.get('doc')
 
+    @property
+    def input_tables(self):
+        if self.is_foreach:
+            return list(distinct(t for q in self.foreach_queries()
+                                 for t in q.input_tables))
+        select = self.data.get('select')
+        if not select:
+            return []
+        return [t.lower() for t in referenced_tables(select)]
+
+    @property
+    def output_tables(self):
+        if self.is_foreach:
+            return list(distinct(t for q in self.foreach_queries()
+                                 for t in q.output_tables))
+        return [out['name'].lower() for out in self.data.get('output', [])
+                if out.get('format') == 'table']
+
+    @property
+    def materialized_table(self):
+        """ Table the query is materialized into, once per run, for the
+        queries referencing it in `with`: when it sets `materialize`, or
+        when it is referenced by at least `materialize_threshold` queries.
+        None when its SQL is inlined as a CTE. """
+        if self.is_foreach or not self.name:
+            return None
+        materialize = self.raw_data.get('materialize')
+        if materialize is None:
+            threshold = self.playbook.config.materialize_threshold
+            materialize = bool(threshold) and \
+                self.playbook.with_references[self.name] >= threshold
+        if not materialize:
+            return None
+        return 'yasql_cte_' + re.sub(r'\W', '_', self.name)
+
+    def reads_materialized(self, query, data):
+        """ Whether `query`, referenced in `with`, is read from its
+        materialized table, which requires both to use the same
+        connection """
+        return query.materialized_table is not None and \
+            query.raw_data.get('connection') == data.get('connection')
+
+    def materialized_queries(self):
+        """ Queries referenced in `with` that are read from tables """
+        queries = [self.playbook.get_query(name)
+                   for name in self.with_queries]
+        return [q for q in queries if self.reads_materialized(q, self.data)]
+
+    @property
+    def timeout(self):
+        """ Seconds each statement of the query may run before it is
+        cancelled, the whole query for asyncio execution """
+        return self.data.get('timeout', self.playbook.config.timeout)
+
     @property
     def db_conn(self):
-        return self.playbook.config.db_conn
+        return self.playbook.config.connection(self.data.get('connection'))
+
+    @property
+    def async_db_conn(self):
+        return self.playbook.config.connection(self.data.get('connection'),
+                                               is_async=True)
+
+def binding_name(name, binding):
+    return '{}[{}]'.format(name, ', '.join(
+        '{}={}'.format(k, v) for k, v in binding.items()))
+
+class BoundQuery(Query):
+    """ A binding of a `foreach` query whose vars are bound parameters: it
+    executes the statement of the query with the values of the binding,
+    only its outputs are rendered with them """
+    def __init__(self, query, binding):
+        super().__init__(query.raw_data, query.playbook, binding=binding)
+        self.name = binding_name(query.name, binding)
+        self.query = query
+
+    def process_keywords(self, data):
+        data = self.query.data
+        vars = overrides(self.playbook.get('vars', {}),
+                         data.get('vars', {}), self.binding)
+        output = [inject_vars(dict_cls(out), vars)
+                  for out in data.get('output', [])]
+        return merge(data, {'output': output})
+
+    def statement(self):
+        return self.query.statement().params(**self.binding)
+
+    def preview_statement(self, rows):
+        return self.query.preview_statement(rows).params(**self.binding)
+
+    def executable(self, async_=False):
+        return self.statement()
+
+    def materialized_queries(self):
+        return self.query.materialized_queries()
 
 class Playbook(object):
     def __init__(self, content, path=None):
-        data = load(content)
+        """ `content` is the YAML source of the playbook, or its parsed
+        data """
+        data = load(content) if isinstance(content, str) else content
         self.path = path
-        self.data = self.process_imports(data)
+        # Files imported by the playbook, directly or not
+        self.import_paths = []
+        # Queries materialized into tables during the current run, by name
+        self.materialized = {}
+        self.materialize_lock = threading.RLock()
+        with profiler.phase('playbook.imports', path=path):
+            self.data = self.process_imports(data)
 
     @classmethod
     def load_from_path(cls, path):
-        with open(path) as f:
-            return Playbook(f.read(), path)
+        return Playbook(load_file(path), path)
 
     def process_imports(self, data):
         imports = data.get('imports', [])
-        base_dir = os.path.dirname(self.path)
+        base_dir = os.path.dirname(self.path or '')
+        loaded = {}
         for imp in imports:
-            playbook = self.load_from_path(os.path.join(base_dir, imp['from']))
+            path = os.path.join(base_dir, imp['from'])
+            if path not in loaded:
+                loaded[path] = self.load_from_path(path)
+                self.import_paths += [os.path.abspath(path)] + \
+                    loaded[path].import_paths
+            playbook = loaded[path]
             namespace = imp.get('as')
             keys = listify(imp['import'])
             for key in keys:
@@ -193,32 +964,199 @@ class Playbook(object):
     def get(self, key, default=None):
         return self.data.get(key, default)
 
+    def update_vars(self, vars):
+        self.data['vars'] = overrides(self.get('vars', dict_cls()), vars)
+        self.invalidate()
+
+    def invalidate(self):
+        for q in self.queries:
+            q.invalidate()
+
     def get_query(self, query_name):
-        queries = [q for q in self.queries if q.name == query_name]
-        if queries:
-            return queries[0]
-        else:
+        try:
+            return self.query_index[query_name]
+        except KeyError:
             raise QueryNotExists(query_name)
 
-    def execute(self, queries=None):
+    def has_query(self, query_name):
+        return query_name in self.query_index
+
+    @property
+    def query_names(self):
+        return list(self.query_index)
+
+    def execute(self, queries=None, jobs=1):
         logger.info('Execute playbook %s', self.path or '')
+        ctx.now = datetime.now()
+        self.begin_run()
+        try:
+            graph = self.graph(queries)
+            if jobs > 1 and any(is_memory_db(q.db_conn)
+                                for q in graph.queries):
+                logger.warning('In-memory SQLite databases are not shared '
+                               'between threads, queries are executed one '
+                               'at a time')
+                jobs = 1
+            run = partial(graph.run, lambda q: q.execute(), jobs=jobs)
+            if any(is_memory_db(q.db_conn) for q in graph.queries):
+                # In-memory databases are private to the thread, Ctrl-C
+                # can't cancel their statements
+                run()
+            else:
+                run_interruptible(run)
+        finally:
+            try:
+                self.drop_materialized()
+            finally:
+                ctx.now = None
+
+    async def execute_async(self, queries=None, concurrency=None):
+        """ Execute queries with the asyncio engines of the connections,
+        running up to `concurrency` queries at the same time """
+        logger.info('Execute playbook %s', self.path or '')
+        ctx.now = datetime.now()
+        self.begin_run()
+        try:
+            await self.graph(queries).run_async(
+                lambda q: q.execute_async(),
+                concurrency or self.config.concurrency)
+        finally:
+            try:
+                await self.drop_materialized_async()
+            finally:
+                ctx.now = None
+
+    @cached_property
+    def with_references(self):
+        """ Number of queries referencing each query in `select.with` """
+        counts = Counter()
+        for q in self.queries:
+            select = q.raw_data.get('select') or {}
+            names = set()
+            for item in listify(select.get('with') or []):
+                names.add(item if isinstance(item, str) else dict_one(item)[1])
+            counts.update(names)
+        return counts
+
+    def materialize(self, query):
+        """ Create the tables of the queries that `query` reads in `with`
+        from their materialized table, once per run """
+        with self.materialize_lock:
+            for q in query.materialized_queries():
+                if q.name in self.materialized:
+                    continue
+                self.materialize(q)
+                execute_transaction(q.db_conn, materialize_statements(q),
+                                    timeout=q.timeout)
+                logger.info('Query %s was materialized into table %s',
+                            q.name, q.materialized_table)
+                self.materialized[q.name] = q
+
+    async def materialize_async(self, query):
+        for q in query.materialized_queries():
+            if q.name not in self.materialized:
+                # Shared by the queries waiting for the same table
+                self.materialized[q.name] = asyncio.ensure_future(
+                    self._materialize_async(q))
+            await self.materialized[q.name]
+
+    async def _materialize_async(self, query):
+        await self.materialize_async(query)
+        await execute_transaction_async(query.async_db_conn,
+                                        materialize_statements(query))
+        logger.info('Query %s was materialized into table %s',
+                    query.name, query.materialized_table)
+        return query
+
+    def drop_materialized(self):
+        """ Drop the tables materialized during the run """
+        materialized, self.materialized = self.materialized, {}
+        for q in materialized.values():
+            execute_transaction(q.db_conn, [
+                'DROP TABLE IF EXISTS {}'.format(q.materialized_table)])
+
+    async def drop_materialized_async(self):
+        materialized, self.materialized = self.materialized, {}
+        for name, future in materialized.items():
+            # The table may exist even when its creation did not complete
+            future.cancel()
+            q = self.get_query(name)
+            await execute_transaction_async(q.async_db_conn, [
+                'DROP TABLE IF EXISTS {}'.format(q.materialized_table)])
+
+    def begin_run(self):
+        # Relative dates are rendered again with the time of this run, the
+        # SQL of other queries is kept. Queries not processed yet have
+        # nothing to drop.
+        for q in self.queries:
+            if q._data is not None and q.uses_dt_expr:
+                q.invalidate()
+        if self.config.manifest is not None:
+            self.config.manifest.begin()
+
+    def plan(self, queries=None, explain=True):
+        """ Execution plan of the queries: stages of queries that can run
+        in parallel, in execution order, their dependencies and, with
+        `explain`, the EXPLAIN output of the database for each query """
+        from tabulate import tabulate
+        graph = self.graph(queries)
+        stages = graph.stages()
+        lines = ['Execution plan: {} queries in {} stages'.format(
+            len(graph.queries), len(stages))]
+        for i, stage in enumerate(stages, 1):
+            lines.append('Stage {}: {}'.format(
+                i, ', '.join(q.name for q in stage)))
+        for q in graph.order():
+            lines.append('')
+            title = 'Query {}'.format(q.name)
+            if q.is_foreach:
+                title += ' ({} bindings)'.format(len(q.bindings()))
+            deps = graph.dependencies(q)
+            if deps:
+                title += ', after {}'.format(', '.join(d.name for d in deps))
+            lines += [title, indent(q.render_sql(), '    ')]
+            if not explain:
+                continue
+            try:
+                keys, rows = explain_sql(q.db_conn, q.compile_sql())
+            except Exception as e:
+                lines.append('    EXPLAIN not available: {}'.format(
+                    str(e).strip().split('\n')[0]))
+            else:
+                lines.append(indent(tabulate(
+                    [tuple(r) for r in rows], headers=keys), '    '))
+        return '\n'.join(lines)
+
+    def graph(self, queries=None):
         if not queries:
             queries = self.queries
         else:
             queries = [self.get_query(q) for q in queries]
-        [q.execute() for q in queries]
+        return QueryGraph(queries)
 
     @cached_property
     def queries(self):
         queries = [Query(q, self) for q in self.data.get('queries', [])]
-        # Check duplicated query names
-        names = [q.name for q in queries if q.name]
-        names = Counter(names)
-        dups = [n for n, cnt in names.items() if cnt > 1]
+        # Index queries by name and check duplicated query names
+        index = OrderedDict()
+        dups = []
+        for q in queries:
+            if not q.name:
+                continue
+            if q.name in index and q.name not in dups:
+                dups.append(q.name)
+            index[q.name] = q
         if dups:
             raise DuplicateQueryNames(dups)
+        self._query_index = index
         return queries
 
+    @property
+    def query_index(self):
+        """ Queries indexed by name, in playbook order """
+        self.queries
+        return self._query_index
+
     @cached_property
     def config(self):
         cfg = Config()
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+class Profiler(object):
+    """ Records wall time and call counts per phase (YAML parsing, keyword
+    processing, rendering, DB execution, ...) and rows fetched per query.
+
+    Times are inclusive: a phase that triggers another one (e.g. a
+    `select.with` keyword rendering the referenced query) includes its
+    time. Hooks registered with `add_hook` are called for every recorded
+    phase with (name, duration in seconds, args), which can be used to
+    forward metrics to other monitoring systems. Hooks are called even
+    when the profiler is disabled.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.hooks = []
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stats = OrderedDict()
+        self.rows = OrderedDict()
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    @property
+    def active(self):
+        return self.enabled or bool(self.hooks)
+
+    @contextmanager
+    def phase(self, name, **args):
+        if not self.active:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - start, args)
+
+    def record(self, name, start, duration, args=None):
+        args = args or {}
+        if self.enabled:
+            with self.lock:
+                stat = self.stats.setdefault(name, [0, 0.0])
+                stat[0] += 1
+                stat[1] += duration
+                self.events.append(
+                    (name, start, duration, threading.get_ident(), args))
+        for hook in self.hooks:
+            hook(name, duration, args)
+
+    def count_rows(self, query, rows):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.rows[query] = self.rows.get(query, 0) + rows
+
+    def summary(self):
+        from tabulate import tabulate
+        rows = [(name, count, '{:.4f}'.format(total),
+                 '{:.4f}'.format(total / count))
+                for name, (count, total) in self.stats.items()]
+        text = tabulate(rows, headers=['phase', 'calls', 'total (s)',
+                                       'mean (s)'])
+        if self.rows:
+            text += '\n\n' + tabulate(list(self.rows.items()),
+                                      headers=['query', 'rows fetched'])
+        return text
+
+    def to_json(self):
+        return OrderedDict([
+            ('phases', OrderedDict(
+                (name, {'calls': count, 'total': total})
+                for name, (count, total) in self.stats.items())),
+            ('rows', self.rows),
+        ])
+
+    def chrome_trace(self):
+        """ Events in the Chrome trace format (chrome://tracing) """
+        pid = os.getpid()
+        return {'traceEvents': [
+            {'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+             'ts': (start - self.origin) * 1e6, 'dur': duration * 1e6,
+             'args': {k: str(v) for k, v in args.items()}}
+            for name, start, duration, tid, args in self.events
+        ]}
+
+    def write(self, format, path):
+        data = self.chrome_trace() if format == 'chrome' else self.to_json()
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+profiler = Profiler()
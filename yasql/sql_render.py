@@ -3,6 +3,7 @@ from sqlalchemy import text, table
 from sqlalchemy.sql.expression import TextAsFrom
 
 from .utils import listify, dict_one
+from .profiling import profiler
 from .syntax.clause import from_clause, where, group_by, order_by, having, limit
 
 
@@ -69,7 +70,8 @@ class SQLRender(object):
         self.processors = [cls() for cls in processors]
 
     def render(self):
-        return self._render(self.data)
+        with profiler.phase('sql.render'):
+            return self._render(self.data)
 
     def _render(self, item):
         for i in range(self.MAX_ITERATION):
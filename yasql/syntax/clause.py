@@ -20,13 +20,15 @@ def clause(call, key):
         return query
     return call()
 
-@clause(key=('from', 'join', 'with'))
-def from_clause(query, data, join, with_):
-    return FromClause().build(query, data, join, with_)
+@clause(key=('from', 'join', 'with', 'sample'))
+def from_clause(query, data, join, with_, sample):
+    return FromClause().build(query, data, join, with_, sample)
 
 class FromClause(object):
-    def build(self, query, data, join, with_):
+    def build(self, query, data, join, with_, sample=None):
         self.ctes = self._build_cte(with_ or [])
+        # Percentage of the rows of the tables read with TABLESAMPLE
+        self.sample = sample
         table = self._build_from(data)
         if join:
             joins = self._build_join(join)
@@ -34,21 +36,31 @@ class FromClause(object):
                 table = table.join(right, on)
         return query.select_from(table)
 
-    def _parse_from(self, sql):
+    def _parse_from(self, sql, alias=None):
         # If sql is a single word, it should be a table or cte
         # Otherwise, it should be a sql
         if ' ' in sql:
-            return TextAsFrom(text(sql), [])
+            item = TextAsFrom(text(sql), [])
         elif sql in self.ctes:
-            return self.ctes[sql]
+            item = self.ctes[sql]
+        elif self.sample:
+            # Keeps the name of the table, so that columns can still be
+            # qualified with it
+            return sa.tablesample(sa.table(sql), self.sample,
+                                  name=alias or sql.rpartition('.')[2])
         else:
-            return sa.table(sql)
+            item = sa.table(sql)
+        return item.alias(alias) if alias else item
 
     def _build_cte(self, with_):
         ctes = {}
         for item in with_:
             alias, sql = dict_one(item)
-            ctes[alias] = TextAsFrom(text(sql), []).cte(alias)
+            if isinstance(sql, dict):
+                # A query materialized into a table
+                ctes[alias] = sa.table(sql['table']).alias(alias)
+            else:
+                ctes[alias] = TextAsFrom(text(sql), []).cte(alias)
         return ctes
 
     def _build_from(self, from_):
@@ -56,26 +68,25 @@ class FromClause(object):
             return self._parse_from(from_)
         elif isinstance(from_, dict):
             alias, from_ = dict_one(from_)
-            return self._parse_from(from_).alias(alias)
+            return self._parse_from(from_, alias)
 
     def _build_join(self, tables):
-        def _parse_join(sql):
+        def _parse_join(sql, alias=None):
             table, _, join = re.split(r'\s+(on|ON)\s+', sql)
-            return (self._parse_from(table), text(join))
+            return (self._parse_from(table, alias), text(join))
 
         def _build_one(table):
             if isinstance(table, str):
                 return _parse_join(table)
             elif isinstance(table, dict):
                 alias, table = dict_one(table)
-                table, join_on = _parse_join(table)
-                return (table.alias(alias), join_on)
+                return _parse_join(table, alias)
 
         return [_build_one(t) for t in listify(tables)]
 
 
-@clause(key='where')
-def where(query, data):
+def build_condition(data):
+    """ SQL condition from the `where` syntax """
     def _build_one(cond):
         if isinstance(cond, str):
             return text('({})'.format(cond))
@@ -99,8 +110,11 @@ def where(query, data):
 
         return (col == val)
 
-    conds = sa.and_(*[_build_one(c) for c in listify(data)])
-    return query.where(conds)
+    return sa.and_(*[_build_one(c) for c in listify(data)])
+
+@clause(key='where')
+def where(query, data):
+    return query.where(build_condition(data))
 
 @clause(key='group_by')
 def group_by(query, data):
@@ -118,3 +132,21 @@ def limit(query, data):
 @clause(key='having')
 def having(query, data):
     return query.having(text(data))
+
+def referenced_tables(select):
+    """ Names of the tables read by `from` and `join` of a select clause """
+    def _table(item):
+        if isinstance(item, dict):
+            _, item = dict_one(item)
+        return item.strip()
+
+    ctes = set()
+    for item in listify(select.get('with') or []):
+        ctes.add(item if isinstance(item, str) else dict_one(item)[0])
+
+    tables = []
+    if select.get('from'):
+        tables.append(_table(select['from']))
+    for item in listify(select.get('join') or []):
+        tables.append(re.split(r'\s+(on|ON)\s+', _table(item))[0])
+    return [t for t in tables if ' ' not in t and t not in ctes]
@@ -2,14 +2,13 @@ import re
 import time
 from datetime import date, datetime
 
-import pytz
-import dateparser as dp
-from freezegun import freeze_time
 from dateutil.relativedelta import relativedelta
-from lark import Lark, Transformer
 
 from yasql.context import ctx
 
+# lark and dateparser are slow to import, they are only loaded once a
+# datetime expression needs to be parsed
+
 grammar = """
 ?start: "datetime |" expr                     -> dt_expr
       | "dt |" expr                           -> dt_expr
@@ -42,10 +41,58 @@ TIME: /\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}/
 %import common.NUMBER
 %ignore WS
 """
-parser = Lark(grammar)
+parsers = {}
+
+def get_parser(kind='lalr'):
+    """ Grammar compiled with the given Lark parser ('lalr' or 'earley').
+    The compiled LALR grammar is cached on disk by Lark. """
+    if kind not in parsers:
+        from lark import Lark
+        parsers[kind] = Lark(grammar, parser=kind, cache=kind == 'lalr')
+    return parsers[kind]
+
+# Default parser, compiled on first use
+parser = None
+
+def parse_tree(expr):
+    global parser
+    if parser is None:
+        parser = get_parser()
+    return parser.parse(expr)
+
 identity = lambda x:x
 
-dt_parse_func = dp.parse
+def dateparser_parse(expr):
+    import dateparser
+    return dateparser.parse(expr)
+
+dt_parse_func = dateparser_parse
+
+abs_formats = {'YEAR': '%Y', 'MONTH': '%Y-%m', 'DAY': '%Y-%m-%d'}
+rel_re = re.compile(
+    r'^(?:(today)|(yesterday)|(this|last) (day|week|month|year)|'
+    r'(\d+) (day|week|month|year)s? ago)$')
+
+def shift(dt, num, unit):
+    if unit == 'week':
+        return dt - relativedelta(days=7 * num)
+    return dt - relativedelta(**{unit + 's': num})
+
+def relative_dt(expr, now):
+    """ Resolve the relative dates of the grammar (today, last month,
+    3 days ago, ...) against `now`. Falls back to dateparser for anything
+    else. """
+    match = rel_re.match(expr)
+    if not match:
+        return dt_parse_func(expr)
+    today, yesterday, this_last, unit, num, ago_unit = match.groups()
+    if today:
+        return now
+    elif yesterday:
+        return shift(now, 1, 'day')
+    elif this_last:
+        return now if this_last == 'this' else shift(now, 1, unit)
+    return shift(now, int(num), ago_unit)
 
 def date_trunc(dt, unit):
     dt = {
@@ -71,10 +118,17 @@ def convert_dt(item, converter, *args):
         return converter(item)
     return tuple((converter(i, *args) if i else None) for i in item)
 
-class DateTransformer(Transformer):
-    def __init__(self):
-        super().__init__()
-        self.tz = ctx.config.timezone
+class DateTransformer(object):
+    """ Same as a lark Transformer of the grammar: calls the method named
+    after each rule, bottom-up, with the transformed children """
+    def __init__(self, tz=None, now=None):
+        self.tz = tz or ctx.config.timezone
+        self.now = now or datetime.now()
+
+    def transform(self, tree):
+        children = [self.transform(c) if hasattr(c, 'data') else c
+                    for c in tree.children]
+        return getattr(self, tree.data)(children)
 
     def dt_expr(self, items):
         return convert_dt(items[0], dt_to_str)
@@ -106,16 +160,12 @@ class DateTransformer(Transformer):
 
     def in_last(self, items):
         num, unit = items
-        return dt_parse_func('{} {} ago'.format(num, unit)), datetime.now()
+        start = relative_dt('{} {} ago'.format(num, unit), self.now)
+        return start, self.now
 
     def abs_dt(self, items):
         item = items[0]
-        if item.type == 'YEAR':
-            val = dt_parse_func('{}-01-01'.format(item))
-        elif item.type == 'MONTH':
-            val = dt_parse_func('{}-01'.format(item))
-        else:
-            val = dt_parse_func(item)
+        val = datetime.strptime(item, abs_formats[item.type])
         unit = item.type.lower()
         return {'val': date_trunc(val, unit), 'unit': unit}
 
@@ -127,12 +177,25 @@ class DateTransformer(Transformer):
                 unit = 'day'
             else:
                 unit = item.replace('this ', '').replace('last ','')
-        val = date_trunc(dt_parse_func(item), unit)
+        val = date_trunc(relative_dt(item, self.now), unit)
         return {'val': val, 'unit': unit}
 
-def parse_dt_expr(expr):
-    tree = parser.parse(expr)
-    return DateTransformer().transform(tree)
+CACHE_SIZE = 4096
+parse_cache = {}
+
+def parse_dt_expr(expr, tz=None, now=None):
+    """ Parse a datetime expression. Results are memoized per expression,
+    timezone and reference time, which defaults to the start time of the
+    current run (ctx.now) so that all queries of a run agree on it. """
+    tz = tz or ctx.config.timezone
+    now = (now or ctx.now or datetime.now()).replace(microsecond=0)
+    key = (expr, repr(tz), now)
+    if key not in parse_cache:
+        if len(parse_cache) >= CACHE_SIZE:
+            parse_cache.clear()
+        tree = parse_tree(expr)
+        parse_cache[key] = DateTransformer(tz, now).transform(tree)
+    return parse_cache[key]
 
 def is_dt_expr(expr):
     return bool(re.match('^(dt|datetime|ts|timestamp)\s+\|', expr))
@@ -152,5 +215,4 @@ if __name__ == '__main__':
     # print(parse("timestamp | in last 2 weeks"))
     # print(parse("ts | in last 2 weeks"))
     # print(parse_dt_expr("dt | in last 7 days"))
-    with freeze_time('2018-01-08 8:00'):
-        print(dt_parse_func('3 days ago'))
+    print(relative_dt('3 days ago', datetime(2018, 1, 8, 8)))
@@ -1,21 +1,57 @@
 import re
 import logging
+import threading
+import importlib
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
 from textwrap import indent
 
-import sqlparse
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
 from funcy import print_calls
-from mako.template import Template
 
 from .base import dict_cls
 from .context import ctx
+from .profiling import profiler
 
 logger = logging.getLogger(__name__)
 
-def sql_format(sql):
+def format_sqlparse(sql):
+    import sqlparse
+    return sqlparse.format(sql, reindent=True, keyword_case='upper')
+
+def format_none(sql):
+    return sql
+
+# Backends of sql_format by name, a `module:function` path can also be used
+formatters = {
+    'sqlparse': format_sqlparse,
+    'none': format_none,
+}
+
+def get_formatter(name):
+    if callable(name):
+        return name
+    if name in formatters:
+        return formatters[name]
+    module, _, func = name.partition(':')
+    if not func:
+        raise Exception('Unknown SQL formatter: {}'.format(name))
+    return getattr(importlib.import_module(module), func)
+
+def sql_format(sql, formatter='sqlparse'):
+    """ Format SQL for display. SQL sent to the database is not formatted,
+    as formatting large queries can be slower than running them. """
     sql = sql.strip()
     if not sql.endswith(';'):
         sql = sql + ';'
-    return sqlparse.format(sql.strip(), reindent=True, keyword_case='upper')
+    with profiler.phase('sql.format'):
+        return get_formatter(formatter)(sql.strip())
+
+def display_sql(sql):
+    """ SQL formatted with the formatter of the current playbook """
+    formatter = ctx.config.sql_formatter if ctx.playbook else 'sqlparse'
+    return sql_format(sql, formatter)
 
 
 def listify(item):
@@ -28,6 +64,15 @@ def listify(item):
     raise Exception("Cannot listfy object: {}".format(item))
 
 
+def freeze(item):
+    """ Hashable snapshot of a nested structure of dicts and lists """
+    if isinstance(item, dict):
+        return tuple((k, freeze(v)) for k, v in item.items())
+    elif isinstance(item, list):
+        return tuple(freeze(i) for i in item)
+    return item
+
+
 def dict_one(item):
     assert len(item) == 1
     return item.copy().popitem()
@@ -66,17 +111,32 @@ def overrides(*layers):
 
     if len(layers) == 2:
         return _merge_two(*layers)
-    return overrides(_merge_two(*layers[:2]), *layers[2:], dict_cls=dict_cls)
+    return overrides(_merge_two(*layers[:2]), *layers[2:])
+
+
+TEMPLATE_CACHE_SIZE = 1024
+single_var_re = re.compile(r'^\${\s*(\w+)\s*}$')
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compile_template(text):
+    from mako.template import Template
+    return Template(text)
+
+
+def has_template_markup(text):
+    return '${' in text or '%' in text or '##' in text
 
 
 def inject_vars(item, vars):
     def _expand(val):
         val = val.strip()
-        match = re.match(r'^\${\s*(\w+)\s*}$', val)
+        if not has_template_markup(val):
+            return val
+        match = single_var_re.match(val)
         if match:
             var_name = match.groups()[0]
             return vars.get(var_name)
-        return Template(val).render(**vars)
+        return compile_template(val).render(**vars)
 
     if isinstance(item, str):
         return _expand(item)
@@ -87,8 +147,277 @@ def inject_vars(item, vars):
             [(k, inject_vars(v, vars)) for k, v in item.items()])
     return item
 
-def execute_sql(conn, sql):
+def log_sql(sql):
+    if logger.isEnabledFor(logging.INFO):
+        logger.info('Execute SQL query:\n%s', indent(display_sql(sql), '    '))
+
+
+def driver_text(sql):
+    """ Statement for a SQL string executed as-is: colons are escaped so
+    that they are not taken as bind parameters """
+    return text(sql.replace(':', '\\:'))
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+class QueryCancelled(Exception):
+    pass
+
+
+# Watchdogs of the statements being executed, and whether all statements
+# are being cancelled after Ctrl-C
+watchdogs = set()
+watchdogs_lock = threading.Lock()
+cancelling = threading.Event()
+
+
+def cancel_statement(dbapi_conn):
+    """ Abort the statement running on a DB-API connection, from another
+    thread, with the cancel method of its driver: interrupt() of sqlite3,
+    cancel() of psycopg2 and others. Returns False when the driver has
+    none. """
+    for method in ('interrupt', 'cancel'):
+        func = getattr(dbapi_conn, method, None)
+        if func is not None:
+            func()
+            return True
+    return False
+
+
+class Watchdog(object):
+    """ Cancels the statement running on a connection once `timeout`
+    seconds have elapsed, or when all statements are cancelled by
+    cancel_running(). The statement then fails with a driver error, which
+    check() turns into QueryTimeout or QueryCancelled. """
+    def __init__(self, conn, timeout=None):
+        self.dbapi_conn = conn.connection.connection
+        self.timeout = timeout
+        self.timed_out = False
+        self.timer = None
+        with watchdogs_lock:
+            watchdogs.add(self)
+        if timeout:
+            self.timer = threading.Timer(timeout, self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def expire(self):
+        with watchdogs_lock:
+            if self not in watchdogs:
+                return
+            self.timed_out = True
+            cancel_statement(self.dbapi_conn)
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        with watchdogs_lock:
+            watchdogs.discard(self)
+
+    def check(self, error):
+        if self.timed_out:
+            raise QueryTimeout('Statement cancelled after {} seconds'.format(
+                self.timeout)) from error
+        if cancelling.is_set():
+            raise QueryCancelled('Statement cancelled') from error
+
+
+class WatchedCursor(object):
+    """ Wraps the result of a statement executed under a watchdog, which is
+    stopped once the result is exhausted or closed """
+    def __init__(self, cursor, watchdog):
+        self.cursor = cursor
+        self.watchdog = watchdog
+
+    def keys(self):
+        return self.cursor.keys()
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def fetch(self, func, *args):
+        try:
+            return func(*args)
+        except Exception as e:
+            self.watchdog.stop()
+            self.watchdog.check(e)
+            raise
+
+    def fetchmany(self, size):
+        rows = self.fetch(self.cursor.fetchmany, size)
+        if len(rows) < size:
+            self.watchdog.stop()
+        return rows
+
+    def fetchall(self):
+        rows = self.fetch(self.cursor.fetchall)
+        self.watchdog.stop()
+        return rows
+
+    def close(self):
+        self.watchdog.stop()
+        self.cursor.close()
+
+
+def execute_sql(conn, sql, stream=False, timeout=None):
+    """ Execute a statement on an engine or a connection. It is cancelled
+    after `timeout` seconds, or by Ctrl-C with run_interruptible(). """
     if ctx.dry:
-        logger.info('Execute SQL query:\n%s', indent(sql, '    '))
+        log_sql(sql)
     else:
-        return conn.execute(sql)
+        if cancelling.is_set():
+            raise QueryCancelled('Execution was cancelled')
+        if stream:
+            # Server-side cursor, so that rows can be fetched in chunks
+            conn = conn.execution_options(stream_results=True)
+        if isinstance(conn, Engine):
+            # The connection is released once the result is consumed
+            conn = conn.connect(close_with_result=True)
+        watchdog = Watchdog(conn, timeout)
+        try:
+            with profiler.phase('db.execute'):
+                result = conn.execute(sql)
+        except Exception as e:
+            watchdog.stop()
+            watchdog.check(e)
+            raise
+        if not result.returns_rows:
+            watchdog.stop()
+            return result
+        return WatchedCursor(result, watchdog)
+
+
+def execute_transaction(conn, statements, timeout=None):
+    if ctx.dry:
+        return [execute_sql(conn, sql) for sql in statements]
+    with conn.begin() as trans_conn:
+        return [execute_sql(trans_conn, sql, timeout=timeout)
+                for sql in statements]
+
+
+def cancel_running():
+    """ Cancel the statements being executed, and the ones about to be """
+    cancelling.set()
+    with watchdogs_lock:
+        for watchdog in watchdogs:
+            cancel_statement(watchdog.dbapi_conn)
+
+
+# Lock waits are not interrupted by signals on all platforms, futures are
+# waited for in steps of POLL_INTERVAL seconds so that Ctrl-C is handled
+POLL_INTERVAL = 0.1
+
+def wait_result(future):
+    while True:
+        try:
+            return future.result(timeout=POLL_INTERVAL)
+        except TimeoutError:
+            continue
+
+
+def run_interruptible(func):
+    """ Call `func` in a worker thread, so that Ctrl-C, which is received by
+    the main thread while drivers block the thread running a statement,
+    cancels the statements being executed. KeyboardInterrupt is raised once
+    `func` is done. """
+    if threading.current_thread() is not threading.main_thread():
+        return func()
+    pool = ThreadPoolExecutor(max_workers=1)
+    future = pool.submit(func)
+    try:
+        return wait_result(future)
+    except KeyboardInterrupt:
+        logger.warning('Interrupted, cancelling running statements')
+        cancel_running()
+        # Another Ctrl-C stops waiting
+        while not future.done():
+            wait([future], timeout=POLL_INTERVAL)
+        raise
+    finally:
+        pool.shutdown(wait=False)
+        if future.done():
+            cancelling.clear()
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+def rows_size(rows):
+    """ Estimated size in bytes of rows: the length of strings and bytes
+    values, 8 bytes for other values """
+    return sum(len(v) if isinstance(v, (str, bytes)) else 8
+               for row in rows for v in row)
+
+
+class Budget(object):
+    """ Limits of the rows and bytes fetched for an output """
+    def __init__(self, max_rows=None, max_bytes=None):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.rows = 0
+        self.bytes = 0
+
+    def consume(self, rows):
+        self.rows += len(rows)
+        if self.max_rows is not None and self.rows > self.max_rows:
+            raise BudgetExceeded('Over the budget of {} rows'.format(
+                self.max_rows))
+        if self.max_bytes is not None:
+            self.bytes += rows_size(rows)
+            if self.bytes > self.max_bytes:
+                raise BudgetExceeded('Over the budget of {} bytes'.format(
+                    self.max_bytes))
+
+
+def table_exists(conn, name):
+    if ctx.dry:
+        return True
+    schema, _, table = name.rpartition('.')
+    with conn.connect() as c:
+        return conn.dialect.has_table(c, table, schema=schema or None)
+
+
+async def execute_transaction_async(engine, statements):
+    if ctx.dry:
+        return [log_sql(sql) for sql in statements]
+    async with engine.begin() as conn:
+        for sql in statements:
+            with profiler.phase('db.execute'):
+                await conn.exec_driver_sql(sql)
+
+
+async def table_exists_async(engine, name):
+    if ctx.dry:
+        return True
+    schema, _, table = name.rpartition('.')
+    async with engine.connect() as conn:
+        return await conn.run_sync(
+            lambda c: c.dialect.has_table(c, table, schema=schema or None))
+
+
+# EXPLAIN statement of each dialect, using the variant that reports
+# estimated rows and cost when the database has several
+explain_formats = {
+    'sqlite': 'EXPLAIN QUERY PLAN {}',
+    'snowflake': 'EXPLAIN USING TEXT {}',
+}
+
+def explain_sql(engine, sql):
+    """ (keys, rows) of the EXPLAIN output of the database for `sql` """
+    fmt = explain_formats.get(engine.dialect.name, 'EXPLAIN {}')
+    with engine.connect() as conn:
+        result = conn.exec_driver_sql(fmt.format(re.sub(';$', '', sql)))
+        return list(result.keys()), result.fetchall()
+
+
+def iter_chunks(cursor, size):
+    while True:
+        with profiler.phase('db.fetch'):
+            rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        yield rows
@@ -0,0 +1,117 @@
+import os
+import time
+import logging
+
+from .context import ctx
+from .playbook import Playbook
+from .yaml_parser import file_stamp
+from .utils import freeze
+
+logger = logging.getLogger(__name__)
+
+class Watcher(object):
+    """ Re-executes a playbook when it or the files it imports change.
+
+    The process, engines and parsed imports stay warm between runs. Only
+    the queries whose YAML, template or vars changed are processed again,
+    then they are executed with the queries depending on them. The other
+    queries are taken over from the previous version of the playbook, with
+    their processed data and rendered SQL.
+    """
+    interval = 1.0
+
+    def __init__(self, path, queries=None, jobs=1, config=None):
+        self.path = path
+        self.queries = queries
+        self.jobs = jobs
+        self.config = config or {}
+        self.playbook = None
+        self.stamps = None
+
+    def load(self):
+        playbook = Playbook.load_from_path(self.path)
+        playbook.config.update(self.config)
+        return playbook
+
+    def files(self):
+        return [os.path.abspath(self.path)] + self.playbook.import_paths
+
+    def file_stamps(self):
+        stamps = {}
+        for path in self.files():
+            try:
+                stamps[path] = file_stamp(path)
+            except OSError:
+                stamps[path] = None
+        return stamps
+
+    def start(self):
+        self.playbook = self.load()
+        self.stamps = self.file_stamps()
+        ctx.playbook = self.playbook
+        self.playbook.execute(queries=self.queries, jobs=self.jobs)
+
+    def check(self):
+        """ Reload and re-execute the playbook if one of its files changed.
+        Returns the names of the executed queries, None without changes. """
+        stamps = self.file_stamps()
+        if stamps == self.stamps:
+            return None
+        self.stamps = stamps
+        playbook = self.load()
+        changed = take_over_queries(self.playbook, playbook)
+        self.playbook = playbook
+        self.stamps = self.file_stamps()
+        ctx.playbook = playbook
+
+        graph = playbook.graph()
+        affected = set()
+        pending = [playbook.get_query(name) for name in changed]
+        while pending:
+            q = pending.pop()
+            if q.name not in affected:
+                affected.add(q.name)
+                pending += graph.dependents(q)
+        names = [q.name for q in graph.order() if q.name in affected and
+                 (not self.queries or q.name in self.queries)]
+        logger.info('Playbook changed, executing %s', ', '.join(names) or
+                    'no queries')
+        for name in names:
+            # Dependents embed the SQL of the queries they reference
+            playbook.get_query(name).invalidate()
+        if names:
+            playbook.execute(queries=names, jobs=self.jobs)
+        return names
+
+    def run(self):
+        self.start()
+        logger.info('Watching %s for changes', ', '.join(self.files()))
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                logger.exception('Execution failed, waiting for changes')
+
+
+def take_over_queries(old, new):
+    """ Names of the queries of `new` that changed since `old`. The queries
+    that didn't change are replaced by the ones of `old`. """
+    shared_changed = any(freeze(old.get(k)) != freeze(new.get(k))
+                         for k in ('vars', 'config'))
+    templates_changed = \
+        freeze(old.get('templates')) != freeze(new.get('templates'))
+    changed = []
+    queries = new.queries
+    for i, q in enumerate(queries):
+        prev = old.query_index.get(q.name)
+        if prev is None or freeze(prev.raw_data) != freeze(q.raw_data):
+            changed.append(q.name)
+            continue
+        if shared_changed or (templates_changed and 'template' in q.raw_data):
+            if freeze(prev.data) != freeze(q.data):
+                changed.append(q.name)
+                continue
+        prev.playbook = new
+        queries[i] = new.query_index[q.name] = prev
+    return changed
@@ -1,8 +1,23 @@
+import os
+import pickle
+import hashlib
+import logging
+import tempfile
+
 import yaml
 
 from .base import dict_cls
+from .profiling import profiler
+
+logger = logging.getLogger(__name__)
+
+# Directory of the on-disk cache of parsed playbooks, disabled when unset
+cache_dir = os.environ.get('YASQL_PLAYBOOK_CACHE')
+# Bumped when the format of parsed playbooks changes
+CACHE_FORMAT = 1
 
-class OrderedLoader(yaml.Loader):
+# Use the libyaml parser when PyYAML was built with it
+class OrderedLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
     pass
 
 def construct_mapping(loader, node):
@@ -21,8 +36,57 @@ def dict_representer(dumper, data):
 
 OrderedDumper.add_representer(dict_cls, dict_representer)
 
-def load(content):
+def parse(content):
     return yaml.load(content, Loader=OrderedLoader)
 
+def load(content):
+    with profiler.phase('yaml.load'):
+        return parse(content)
+
 def dump(obj):
     return yaml.dump(obj, Dumper=OrderedDumper)
+
+# Parsed files by absolute path, as (stamp, pickled content) so that each
+# load returns a fresh copy that can be modified by the caller
+file_cache = {}
+
+def file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+def load_file(path):
+    """ Parsed content of a YAML file, cached in the process (and on disk
+    when `cache_dir` is set) until the file is modified """
+    path = os.path.abspath(path)
+    with profiler.phase('yaml.load', path=path):
+        stamp = file_stamp(path)
+        entry = file_cache.get(path)
+        if entry is None or entry[0] != stamp:
+            entry = file_cache[path] = (stamp, load_pickled(path, stamp))
+        return pickle.loads(entry[1])
+
+def load_pickled(path, stamp):
+    cache_path = None
+    if cache_dir:
+        key = '{}:{}:{}:{}'.format(path, stamp[0], stamp[1], CACHE_FORMAT)
+        cache_path = os.path.join(os.path.expanduser(cache_dir),
+                                  hashlib.sha256(key.encode()).hexdigest())
+        try:
+            with open(cache_path, 'rb') as f:
+                return f.read()
+        except OSError:
+            pass
+    with open(path) as f:
+        content = pickle.dumps(parse(f.read()), pickle.HIGHEST_PROTOCOL)
+    if cache_path:
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path),
+                                            suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning('Cannot write playbook cache %s: %s',
+                           cache_path, e)
+    return content